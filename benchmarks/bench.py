@@ -0,0 +1,164 @@
+'''
+Benchmark the runner throughput against the fake udata API.
+
+Each scenario runs in its own process (so peak memory usage is its own)
+and results are appended to `benchmarks/results.jsonl` with the current commit
+to track them over time:
+
+    python benchmarks/bench.py --queries 100,10000,100000
+'''
+import argparse
+import asyncio
+import csv
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from server import FakeUdata  # noqa: E402
+from tasks import PROGRESS_MODES, Runner, percentile  # noqa: E402
+
+DEFAULT_QUERIES = '100,10000,100000'
+DEFAULT_OUTPUT = ROOT / 'benchmarks' / 'results.jsonl'
+BASENAMES = ('datasets', 'organizations', 'reuses')
+# Share of queries whose expected item is not in the results
+NOT_FOUND_RATE = 0.1
+LAG_INTERVAL = 0.01  # in seconds
+SCENARIO_OPTIONS = ('items', 'results', 'max_page_size', 'latency', 'error_rate',
+                    'max_pages', 'concurrency', 'max_concurrency', 'workers', 'progress')
+
+
+def generate_queries(server, data_dir, count, seed=0):
+    '''
+    Write `count` queries spread over all models CSVs,
+    with expected items ranked following a geometric distribution.
+    '''
+    rnd = random.Random(seed)
+    for index, basename in enumerate(BASENAMES):
+        with (data_dir / f'{basename}.csv').open('w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(('query', 'params', 'expected'))
+            for number in range(index, count, len(BASENAMES)):
+                query = f'query {number}'
+                results = server.search(basename, query)
+                if rnd.random() < NOT_FOUND_RATE:
+                    expected = server.item_id(server.items + number)
+                else:
+                    rank = min(int(rnd.expovariate(0.3)), len(results) - 1)
+                    expected = results[rank]
+                writer.writerow((query, '', expected))
+
+
+async def monitor_lag(lags):
+    '''Measure the event loop lag as the delay of a periodic wake up'''
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - start - LAG_INTERVAL)
+
+
+async def run_scenario(args):
+    server = FakeUdata(args.items, args.results, args.max_page_size, args.latency,
+                       args.error_rate)
+    port = await server.start()
+    with tempfile.TemporaryDirectory() as data_dir:
+        data_dir = Path(data_dir)
+        generate_queries(server, data_dir, args.scenario)
+        runner = Runner(f'127.0.0.1:{port}', args.max_pages, scheme='http',
+                        concurrency=args.concurrency, max_concurrency=args.max_concurrency,
+                        workers=args.workers, data_dir=data_dir, progress=args.progress)
+        lags = []
+        monitor = asyncio.ensure_future(monitor_lag(lags))
+        start = time.monotonic()
+        # Progress is tracked as in a real run, its overhead being part of the benchmark
+        await runner.process()
+        duration = time.monotonic() - start
+        monitor.cancel()
+    await server.stop()
+    lags.sort()
+    queries = runner.metrics.total
+    return {
+        'queries': queries,
+        'duration': round(duration, 3),
+        'qps': round(queries / duration, 1),
+        'http_calls': runner.api.calls,
+        'calls_per_query': round(runner.api.calls / queries, 3) if queries else None,
+        'server_requests': server.stats['requests'],
+        # Linux reports it in KB
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'loop_lag_p50_ms': round(percentile(lags, 50) * 1000, 2) if lags else None,
+        'loop_lag_p99_ms': round(percentile(lags, 99) * 1000, 2) if lags else None,
+        'loop_lag_max_ms': round(lags[-1] * 1000, 2) if lags else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the runner against a fake udata API')
+    parser.add_argument('--queries', default=DEFAULT_QUERIES,
+                        help='Comma-separated numbers of queries of each scenario')
+    parser.add_argument('--items', type=int, default=1000, help='Items per model')
+    parser.add_argument('--results', type=int, default=70, help='Results per query')
+    parser.add_argument('--max-page-size', type=int, default=100)
+    parser.add_argument('--latency', default='lognormal:0.005:0.5',
+                        help='Server latency distribution (see server.parse_latency)')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-pages', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--max-concurrency', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=100)
+    parser.add_argument('--progress', default='tty', choices=sorted(PROGRESS_MODES),
+                        help='Progress display mode of the runner')
+    parser.add_argument('--output', default=str(DEFAULT_OUTPUT))
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        loop = asyncio.get_event_loop()
+        print(json.dumps(loop.run_until_complete(run_scenario(args))))
+        return
+
+    options = []
+    for name in SCENARIO_OPTIONS:
+        options.extend(('--' + name.replace('_', '-'), str(getattr(args, name))))
+    commit = git_commit()
+    for count in (int(value) for value in args.queries.split(',')):
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--scenario', str(count)] + options,
+            universal_newlines=True,
+        )
+        result = json.loads(output.splitlines()[-1])
+        print('{queries} queries: {qps} queries/s, {calls_per_query} calls/query, '
+              '{peak_rss_mb} MB peak RSS, loop lag p99 {loop_lag_p99_ms} ms'.format(**result))
+        record = {
+            'commit': commit,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'scenario': dict(queries=count, **{name: getattr(args, name)
+                                               for name in SCENARIO_OPTIONS}),
+            'results': result,
+        }
+        with open(args.output, 'a', encoding='utf-8') as jsonfile:
+            jsonfile.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
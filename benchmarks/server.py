@@ -0,0 +1,171 @@
+'''
+A fake udata API for benchmarking the runner without hitting a real server.
+
+It implements the endpoints used by the runner:
+- `/api/1/{model}/{id}/` returning an item
+- `/api/2/{model}/search/` returning a deterministic page of results for a query
+
+It can also be run standalone:
+
+    python benchmarks/server.py --port 8000 --latency lognormal:0.02:0.5
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+MODELS = ('datasets', 'organizations', 'reuses')
+
+REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    404: 'Not Found',
+    503: 'Service Unavailable',
+}
+
+
+def parse_latency(spec):
+    '''
+    Parse a latency distribution as `name:arg1:arg2` (in seconds), one of:
+    `constant:value`, `uniform:min:max`, `lognormal:median:sigma`.
+    '''
+    name, *args = spec.split(':')
+    args = [float(arg) for arg in args]
+    if name == 'constant':
+        return lambda rnd: args[0]
+    elif name == 'uniform':
+        return lambda rnd: rnd.uniform(*args)
+    elif name == 'lognormal':
+        median, sigma = args
+        return lambda rnd: median * rnd.lognormvariate(0, sigma)
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+class FakeUdata:
+    '''
+    A fake udata API server.
+
+    Each model has `items` items and each query matches a deterministic set of `results` of them.
+    Search pages are capped to `max_page_size` results,
+    responses are delayed following the `latency` distribution
+    and fail with a `503` (retried by the runner) at `error_rate`.
+    '''
+    def __init__(self, items=1000, results=70, max_page_size=100, latency='constant:0',
+                 error_rate=0, seed=0):
+        self.items = items
+        self.results = results
+        self.max_page_size = max_page_size
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.stats = Counter()
+        self.server = None
+
+    def item_id(self, index):
+        return '{0:024x}'.format(index)
+
+    def search(self, model, query):
+        '''The ordered ids of the items matching a query'''
+        rnd = random.Random(f'{self.seed}:{model}:{query}')
+        return [self.item_id(index) for index in rnd.sample(range(self.items), self.results)]
+
+    def item(self, model, id):
+        return {'id': id, 'title': f'{model} {id}', 'slug': id, 'page': f'/{model}/{id}/'}
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b''):
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                status, body, extra = await self.respond(line.split()[1].decode(), headers)
+                head = [f'HTTP/1.1 {status} {REASONS[status]}', f'Content-Length: {len(body)}']
+                head.extend(f'{name}: {value}' for name, value in extra.items())
+                writer.write('\r\n'.join(head).encode('latin-1') + b'\r\n\r\n' + body)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, path, headers):
+        self.stats['requests'] += 1
+        await asyncio.sleep(self.latency(self.random))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return 503, b'', {'Retry-After': '0'}
+        url = urlsplit(path)
+        parts = [part for part in url.path.split('/') if part]
+        if len(parts) == 4 and parts[:2] == ['api', '2'] and parts[2] in MODELS:
+            self.stats['searches'] += 1
+            body = self.search_page(parts[2], parse_qs(url.query))
+        elif len(parts) == 4 and parts[:2] == ['api', '1'] and parts[2] in MODELS:
+            self.stats['items'] += 1
+            body = self.item(parts[2], parts[3])
+        else:
+            return 404, b'', {}
+        content = json.dumps(body).encode('utf-8')
+        etag = '"{0}"'.format(hashlib.md5(content).hexdigest())
+        extra = {'Content-Type': 'application/json', 'ETag': etag}
+        if headers.get('if-none-match') == etag:
+            return 304, b'', extra
+        return 200, content, extra
+
+    def search_page(self, model, params):
+        query = params.get('q', [''])[0]
+        page = int(params.get('page', ['1'])[0])
+        page_size = min(int(params.get('page_size', ['20'])[0]), self.max_page_size)
+        ids = self.search(model, query)
+        start = (page - 1) * page_size
+        return {
+            'data': [{'id': id, 'title': f'{model} {id}'} for id in ids[start:start + page_size]],
+            'page': page,
+            'page_size': page_size,
+            'total': len(ids),
+            'next_page': f'?page={page + 1}' if start + page_size < len(ids) else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake udata API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--results', type=int, default=70)
+    parser.add_argument('--max-page-size', type=int, default=100)
+    parser.add_argument('--latency', default='constant:0')
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+    server = FakeUdata(args.items, args.results, args.max_page_size, args.latency,
+                       args.error_rate)
+    loop = asyncio.get_event_loop()
+    port = loop.run_until_complete(server.start(args.host, args.port))
+    print(f'Serving a fake udata API on http://{args.host}:{port}/api/')
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,85 +1,177 @@
 import argparse
+import asyncio
 import csv
-import requests
-import tqdm
+import hashlib
+import json
+import sys
+
+from collections import Counter
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from urllib.parse import urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tasks import (API, PROGRESS_MODES, AdaptiveLimiter, atomic_write,  # noqa: E402
+                   progress_bar, run_pool)
 
 MIN_REFERRALS = 4
 DEFAULT_DOMAIN = 'www.data.gouv.fr'
 DEFAULT_STATS_DOMAIN = 'stats.data.gouv.fr'
 DEFAULT_SITE_ID = 109
+DEFAULT_DAYS = 30
+DEFAULT_LIMIT = 1000
+DEFAULT_CACHE_DIR = 'data/matomo'
+# Days reports may still change until Matomo archived them, this long after the day end
+ARCHIVING_DELAY = timedelta(days=1)
+CONCURRENCY = 20
 
 
 class MatomoQueryDatasetBuilder:
+    '''
+    Build a queries dataset from the Matomo site searches leading to datasets pages.
+
+    Matomo reports are requested for each of the last `days` days
+    and cached on disk once archived (past `ARCHIVING_DELAY`, they do not change anymore),
+    so refreshing the dataset only requests the days not seen yet.
+    Requests share the runner API connection pool, concurrency limiter and retries.
+    '''
 
     base_param = {
         'module': 'API',
         'format': 'json',
         'token_auth': 'anonymous',
-        'period': 'range',
-        'date': 'previous30',
+        'period': 'day',
     }
 
-    def __init__(self, stats_domain, dataset_domain, site_id, scheme, dataset_path):
+    def __init__(self, stats_domain, dataset_domain, site_id, scheme, dataset_path,
+                 days=DEFAULT_DAYS, limit=DEFAULT_LIMIT, cache_dir=DEFAULT_CACHE_DIR,
+                 concurrency=CONCURRENCY):
         self.stats_domain = stats_domain
         self.dataset_domain = dataset_domain
-        self.base_param['idSite'] = site_id
+        self.site_id = site_id
         self.scheme = scheme
         self.base_url = f'{self.scheme}://{self.stats_domain}/index.php'
         self.dataset_path = dataset_path
-
-    def get_pages_following_site_searches(self):
+        self.limit = limit
+        self.concurrency = concurrency
+        today = date.today()
+        self.days = [today - timedelta(days=n) for n in range(1, days + 1)]
+        self.cache_dir = Path(cache_dir) / f'{stats_domain}-{site_id}'
+        self.limiter = AdaptiveLimiter(concurrency, concurrency)
+        self.api = API(dataset_domain, scheme, limiter=self.limiter)
+        self.stats = Counter()
+
+    async def get_report(self, day, **params):
+        '''Get a Matomo report for a given day, from the disk cache if already fetched'''
+        params = {**self.base_param, 'idSite': self.site_id, 'date': day.isoformat(), **params}
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        filename = self.cache_dir / day.isoformat() / f'{key}.json'
+        if filename.exists():
+            self.stats['cached'] += 1
+            with filename.open(encoding='utf-8') as jsonfile:
+                return json.load(jsonfile)
+        response = await self.api.fetch_url(f'{self.base_url}?{urlencode(params)}')
+        data = json.loads(response.content)
+        if isinstance(data, dict) and data.get('result') == 'error':
+            raise ValueError(data.get('message'))
+        self.stats['fetched'] += 1
+        if not self.archived(day):
+            return data
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(filename, encoding='utf-8') as jsonfile:
+            json.dump(data, jsonfile)
+        return data
+
+    def archived(self, day):
+        '''Whether a day reports are final (and can be cached)'''
+        return datetime.now() - datetime.combine(day + timedelta(days=1), time()) >= ARCHIVING_DELAY
+
+    async def get_pages_following_site_searches(self):
         '''Get the most popular fr/datasets pages that follow a site search'''
-        r = requests.get(self.base_url, params={**self.base_param,
-                                                'method': 'Actions.getPageUrlsFollowingSiteSearch',
-                                                'expanded': 1,
-                                                'filter_limit': 10})
-
-        r.raise_for_status()
-        pages = r.json()
-        pages = next(elem for elem in pages if elem['label'] == 'fr')['subtable']
-        pages = next(elem for elem in pages if elem['label'] == 'datasets')['subtable']
-        pages = [elem['label'] for elem in pages if elem['label'] not in ['/index', '/?q=', 'Others']]
-        return pages
-
-    def get_page_id(self, page):
+        reports = await asyncio.gather(*(
+            self.get_report(day, method='Actions.getPageUrlsFollowingSiteSearch',
+                            expanded=1, filter_limit=self.limit)
+            for day in self.days
+        ))
+        hits = Counter()
+        for pages in reports:
+            try:
+                pages = next(elem for elem in pages if elem['label'] == 'fr')['subtable']
+                pages = next(elem for elem in pages if elem['label'] == 'datasets')['subtable']
+            except StopIteration:
+                # No dataset page visited after a search that day
+                continue
+            for elem in pages:
+                if elem['label'] not in ['/index', '/?q=', 'Others']:
+                    hits[elem['label']] += elem.get('nb_hits', 1)
+        return [page for page, _ in hits.most_common(self.limit)]
+
+    async def get_page_id(self, page):
         '''Get page id from the page name'''
-        r = requests.get(f'{self.scheme}://{self.dataset_domain}/api/1/datasets/' + page + '/')
-        r.raise_for_status()
-        return r.json()['id']
-
-
-    def get_page_searches(self, page):
-        '''Get searches that led to the page with a number of referrals >= MIN_REFERRALS'''
-        r = requests.get(self.base_url, params={**self.base_param,
-                                                'method': 'Transitions.getTransitionsForPageUrl',
-                                                'pageUrl': f'https://{self.dataset_domain}/fr/datasets/' + page + '/',
-                                                'filter_limit': 50,
-                                                'limitBeforeGrouping': 50,
-                                                })
-        r.raise_for_status()    
-        queries = r.json()['previousSiteSearches'][:-1]
-        queries = [elem['label'] for elem in queries if elem['referrals'] >= MIN_REFERRALS]
-        return queries
-
+        return (await self.api.get('datasets/' + page + '/'))['id']
+
+    async def get_page_searches(self, page, day):
+        '''Get the searches that led to the page on a given day with their referrals'''
+        report = await self.get_report(
+            day,
+            method='Transitions.getTransitionsForPageUrl',
+            pageUrl=f'https://{self.dataset_domain}/fr/datasets/' + page + '/',
+            filter_limit=50,
+            limitBeforeGrouping=50,
+        )
+        return {
+            elem['label']: elem['referrals']
+            for elem in report['previousSiteSearches']
+            # Searches past the limit are grouped in a single row
+            if elem['label'] != 'Others'
+        }
+
+    async def get_page_queries(self, page):
+        '''
+        Get a page id and the searches that led to it
+        with a number of referrals >= MIN_REFERRALS over all days
+        '''
+        page_id, *searches = await asyncio.gather(
+            self.get_page_id(page),
+            *(self.get_page_searches(page, day) for day in self.days)
+        )
+        referrals = Counter()
+        for day_searches in searches:
+            referrals.update(day_searches)
+        queries = [query for query, count in referrals.most_common() if count >= MIN_REFERRALS]
+        return {'page': page, 'id': page_id, 'queries': queries}
 
     def save_query_dataset(self, page_query_dict, page_ids):
         '''Save the queries with their associated pages'''
-        with open(f'data/{self.dataset_path}', 'w', newline='', encoding='utf-8') as csvfile:
+        with open(self.dataset_path, 'w', newline='', encoding='utf-8') as csvfile:
             writer = csv.writer(csvfile)
             for page in page_query_dict:
                 writer.writerows([(query, None, page_ids[page]) for query in page_query_dict[page]])
 
-
-    def create_query_dataset(self):
-        '''Create a test dataset with queries and their expected datasets based on matomo search logs'''
-        pages = self.get_pages_following_site_searches()
-
-        page_ids = {page: self.get_page_id(page) for page in pages}
-
-        page_query_dict = {}
-        for page in tqdm.tqdm(pages):
-            queries = self.get_page_searches(page)
-            page_query_dict[page] = queries
+    async def create_query_dataset(self, bar):
+        '''
+        Create a test dataset with queries and their expected datasets
+        based on matomo search logs
+        '''
+        try:
+            pages = await self.get_pages_following_site_searches()
+
+            page_ids = {}
+            page_query_dict = {}
+
+            def on_result(result):
+                # Failed pages have an empty result
+                if result:
+                    page_ids[result['page']] = result['id']
+                    page_query_dict[result['page']] = result['queries']
+                else:
+                    self.stats['failed'] += 1
+
+            jobs = ((page, self.get_page_queries(page)) for page in pages)
+            await run_pool(jobs, bar, self.concurrency, on_result)
+        finally:
+            await self.api.close()
 
         self.save_query_dataset(page_query_dict, page_ids)
 
@@ -94,14 +186,35 @@ if __name__ == '__main__':
     parser.add_argument('--dataset-domain', dest="dataset_domain", default=DEFAULT_DOMAIN)
     parser.add_argument('--site-id', dest="site_id", type=int, default=DEFAULT_SITE_ID)
     parser.add_argument('--scheme', dest="scheme", default='https')
-    parser.add_argument('--output-dataset-path', dest="output_dataset_path", default='data/datasets_stats.csv')
+    parser.add_argument('--output-dataset-path', dest="output_dataset_path",
+                        default='data/datasets_stats.csv')
+    parser.add_argument('--days', dest="days", type=int, default=DEFAULT_DAYS,
+                        help='Number of past days to build the dataset from')
+    parser.add_argument('--limit', dest="limit", type=int, default=DEFAULT_LIMIT,
+                        help='Maximum number of dataset pages')
+    parser.add_argument('--cache-dir', dest="cache_dir", default=DEFAULT_CACHE_DIR,
+                        help='Where Matomo daily reports are cached')
+    parser.add_argument('--concurrency', dest="concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument('--progress', dest="progress", default='auto',
+                        choices=['auto', *PROGRESS_MODES])
     args = parser.parse_args()
 
-    print('Running dataset builder on {0}', args.stats_domain)
-    print('This operation may take a long time')
-    dataset_builder = MatomoQueryDatasetBuilder(args.stats_domain, args.dataset_domain, args.site_id, args.scheme, args.output_dataset_path)
+    print(f'Running dataset builder on {args.stats_domain}')
+    dataset_builder = MatomoQueryDatasetBuilder(args.stats_domain, args.dataset_domain,
+                                                args.site_id, args.scheme,
+                                                args.output_dataset_path, args.days, args.limit,
+                                                args.cache_dir, args.concurrency)
+    loop = asyncio.get_event_loop()
+    bar = progress_bar('Fetching pages searches', args.progress)
     try:
-        count_queries = dataset_builder.create_query_dataset()
-        print(f'Created {args.output_dataset_path} with {count_queries} queries based on {args.stats_domain}')
+        count_queries = loop.run_until_complete(
+            bar.track(dataset_builder.create_query_dataset(bar))
+        )
+        print(f'Created {args.output_dataset_path} with {count_queries} queries '
+              f'based on {args.stats_domain} '
+              '({0[fetched]} reports fetched, {0[cached]} from cache, {0[failed]} pages failed)'
+              .format(dataset_builder.stats))
     except Exception as e:
         print("Error: Failed to build query dataset from matomo stats. Error: " + str(e))
+    finally:
+        loop.close()
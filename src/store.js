@@ -9,9 +9,91 @@ const debug = process.env.NODE_ENV !== 'production'
 
 async function getData(path) {
     const response = await fetch(`./data/${path}`)
+    if (!response.ok) {
+        throw new Error(`${path}: ${response.status} ${response.statusText}`)
+    }
+    if (path.endsWith('.gz') && !response.headers.get('Content-Encoding')) {
+        // Precompressed files served as is are decompressed here
+        return await new Response(response.body.pipeThrough(new DecompressionStream('gzip'))).json()
+    }
     return await response.json()
 }
 
+function isPacked(run) {
+    // Packed runs are a single archive, their queries being loaded from a precompressed file
+    return run.file.endsWith('.gz')
+}
+
+async function getRange(path, offset, length) {
+    const response = await fetch(`./data/${path}`, {
+        headers: { Range: `bytes=${offset}-${offset + length - 1}` },
+    })
+    const data = await response.arrayBuffer()
+    // Servers ignoring ranges send the whole file
+    return response.status === 206 ? data : data.slice(offset, offset + length)
+}
+
+async function getPackedItem(state, id) {
+    // Each packed item is a raw deflate range of the run archive
+    const [offset, length] = state.pack.items[state.model.path][id]
+    const data = await getRange(`${state.domain}/${state.run.dirname}/${state.pack.file}`, offset, length)
+    const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate-raw'))
+    return await new Response(stream).json()
+}
+
+async function getIndex(state) {
+    // Runs without index (not updated since) only have their whole results file
+    try {
+        return await getData(`${state.domain}/${state.run.dirname}/index.json`)
+    } catch (error) {
+        const { queries, ...details } = await getData(`${state.domain}/${state.run.file}`)
+        details.models = {}
+        queries.filter(query => query && query.model).forEach(query => {
+            const model = details.models[query.model] || (details.models[query.model] = { count: 0, queries: [] })
+            model.count++
+            model.queries.push(query)
+        })
+        return details
+    }
+}
+
+async function getSummaries(state, model) {
+    // Each model queries summaries are loaded on first display
+    const index = state.details.models[model]
+    if (!index) {
+        return []
+    }
+    return index.queries || await getData(`${state.domain}/${state.run.dirname}/${index.summaries}`)
+}
+
+async function getQuery(state, summary) {
+    // Indexed queries details are a line of their model file, others are already complete
+    if (summary.offset === undefined) {
+        return summary
+    }
+    const file = state.details.models[summary.model].file
+    const data = await getRange(`${state.domain}/${state.run.dirname}/${file}`, summary.offset, summary.length)
+    return JSON.parse(new TextDecoder().decode(data))
+}
+
+async function getManifest(state) {
+    // Runs reference their items in the domain content-addressed store.
+    // Older runs without manifest store their items payloads next to their queries.
+    try {
+        return await getData(`${state.domain}/${state.run.dirname}/items.json`)
+    } catch (error) {
+        return undefined
+    }
+}
+
+function itemPath(state, id) {
+    const hashes = state.manifest ? state.manifest[state.model.path] || {} : {}
+    if (hashes[id]) {
+        return `${state.domain}/objects/${hashes[id]}.json`
+    }
+    return `${state.domain}/${state.run.dirname}/${state.model.path}/${id}.json`
+}
+
 const state = {
     loading: false,
     config: {},
@@ -19,6 +101,9 @@ const state = {
     toc: undefined,
     run: undefined,
     details: undefined,
+    summaries: {},
+    manifest: undefined,
+    pack: undefined,
     model: models[0],
     query: undefined,
     item: undefined,
@@ -29,16 +114,12 @@ const state = {
 const getters = {
   currentDate: state => state.run ? format(new Date(state.run.date), 'DD/MM/YYYY HH:mm') : undefined,
   currentQuery: state => state.query ? state.query.query : undefined,
-  queries: state => state.details ? state.details.queries.filter(query => query.model == state.model.name): undefined,
-  queryCounter: state => state.details ? state.details.queries.reduce((result, query) => {
-    if (!result.hasOwnProperty(query.model)) {
-      result[query.model] = 1
-    } else {
-      result[query.model]++
-    }
+  queries: state => state.details ? state.summaries[state.model.name] || [] : undefined,
+  queryCounter: state => state.details ? Object.keys(state.details.models).reduce((result, model) => {
+    result[model] = state.details.models[model].count
     return result
   }, {}) : undefined,
-  getItem: state => id => state.items.find(item => item.id == id),
+  getItem: state => id => state.items[id],
   oembedApi: state => state.details ? `${state.details.server}/api/1/oembed` : undefined,
 };
 
@@ -60,19 +141,29 @@ const mutations = {
     },
     details(state, value) {
         state.details = value
+        state.summaries = {}
+    },
+    summaries(state, { model, queries }) {
+        state.summaries = { ...state.summaries, [model]: queries }
+    },
+    manifest(state, value) {
+        state.manifest = value
+    },
+    pack(state, value) {
+        state.pack = value
     },
     model(state, value) {
         state.model = value
     },
     query(state, value) {
         state.query = value
-        state.items = []
+        state.items = {}
     },
     item(state, value) {
         state.item = value
     },
     addItem(state, value) {
-        state.items.push(value)
+        state.items = { ...state.items, [value.id]: value }
     },
     items(state, value) {
         state.items = value
@@ -112,24 +203,54 @@ const actions = {
         commit('run', run)
         await dispatch('getDetails')
     },
-    async getDetails({ commit, state }) {
+    async getDetails({ commit, dispatch, state }) {
         try {
             commit('loading', true)
-            const response = await getData(
-                `${state.domain}/${state.run.file}`
-            )
-            commit('details', response)
+            // Only the run index is loaded, queries details are loaded when displayed
+            commit('details', await getIndex(state))
+            await dispatch('getSummaries', state.model.name)
+            if (isPacked(state.run)) {
+                commit('pack', await getData(`${state.domain}/${state.run.dirname}/pack.json`))
+                commit('manifest', undefined)
+            } else {
+                commit('pack', undefined)
+                commit('manifest', await getManifest(state))
+            }
             commit('loading', false)
         } catch (error) {
             console.error(error)
         }
     },
-    async setModel({ commit }, model) {
+    async getSummaries({ commit, state }, model) {
+        if (!state.summaries[model]) {
+            commit('summaries', { model, queries: await getSummaries(state, model) })
+        }
+    },
+    async setModel({ commit, dispatch }, model) {
       commit('model', model)
+      try {
+          commit('loading', true)
+          await dispatch('getSummaries', model.name)
+          commit('loading', false)
+      } catch (error) {
+          console.error(error)
+      }
     },
     async setQuery({ commit, state, dispatch }, uid) {
         try {
-            const q = state.details.queries.find(row => row.uid == uid )
+            commit('loading', true)
+            // The query may belong to any model, starting with the displayed one
+            const names = [state.model.name, ...Object.keys(state.details.models)]
+            let summary
+            for (const name of names) {
+                await dispatch('getSummaries', name)
+                summary = state.summaries[name].find(query => query.uid == uid)
+                if (summary) {
+                    break
+                }
+            }
+            const q = await getQuery(state, summary)
+            commit('loading', false)
             const model = models.find(model => model.name == q.model)
             commit('model', model)
             commit('query', q)
@@ -143,9 +264,7 @@ const actions = {
         try {
             if (!getters.getItem(id)) {
                 commit('loading', true)
-                const item = await getData(
-                    `${state.domain}/${state.run.dirname}/${state.model.path}/${id}.json`
-                )
+                const item = state.pack ? await getPackedItem(state, id) : await getData(itemPath(state, id))
                 commit('addItem', item)
                 commit('loading', false)
             }
@@ -4,7 +4,8 @@ These scripts are meant to build the data for the search result indicator dashbo
 It perform the following tasks:
 - It parce a CSV file to perform search queries on a target udata instance,
 - rank the expected results on the target udata instance
-- store the query results details (including items payloads) as JSON files
+- store the query results details as JSON files
+- store the items payloads in a content-addressed store shared by all runs of a domain
 
 It makes use of the udata API wich returns the same result as the front end.
 
@@ -16,27 +17,77 @@ with the following columns (names matters):
 - `expected`: The expected item id
 
 '''
+import array
 import asyncio
+import cProfile
 import csv
+import gzip
+import hashlib
+import inspect
 import itertools
 import httpx
 import json
+import math
 import os
+import pstats
+import random
+import shutil
+import sqlite3
+import struct
 import sys
+import time
 import uuid
 import warnings
+import zipfile
+import zlib
 
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 from datetime import datetime
-from glob import glob
-from invoke import task
+from email.utils import parsedate_to_datetime
+from invoke import Exit, task
 from pathlib import Path
 from progress.bar import ChargingBar
 from urllib.parse import parse_qs, urlencode
 
+try:
+    import brotli
+except ImportError:  # Optional: no `.br` precompressed files without it
+    brotli = None
+
 DEFAULT_DOMAIN = 'www.data.gouv.fr'
 PAGE_SIZE = 20
 TIMEOUT = 10
 CONCURRENCY = 20
+MAX_CONCURRENCY = 100
+WORKERS = MAX_CONCURRENCY
+GLOBAL_CONCURRENCY = 50
+RUN_FORMAT = '%Y-%m-%d-%H-%M'  # Runs directories names
+SEARCH_MEMO_SIZE = 10000  # in pages
+HEADER_CHUNK = 4096  # in bytes
+PACK_FILE = 'run.zip'  # Packed runs archive (see RunPack)
+ITEMS_DIRS = ('datasets', 'organizations', 'reuses')  # Items directories, by model
+TOC_FIELDS = ('date', 'total', 'found', 'ranks', 'avg_rank', 'score', 'confidence', 'latency',
+              'sample', 'replay')
+LATENCY_PERCENTILES = (50, 95, 99)
+RUN_FIELDS = ('run_id', 'sample', 'replay')  # Run header fields not computed from its results
+CONFIDENCE_LEVEL = 0.95
+CONFIDENCE_Z = 1.959964  # The standard normal quantile for CONFIDENCE_LEVEL
+PROGRESS_WINDOW = 10  # Number of tasks displayed
+PROGRESS_INTERVAL = 10  # in seconds, for JSON progress reports
+RETRIES = 3
+WATCH_JITTER = 0.1  # Maximum random delay of watched runs, as a fraction of their period
+WATCH_MIN_PERIOD = 60  # in seconds, runs being named by the minute
+STATUS_PORT = 8642
+RETRY_STATUSES = (429, 502, 503, 504)
+BACKOFF_BASE = 0.5  # in seconds
+BACKOFF_MAX = 30  # in seconds
+# Request headers making a response depend on the local items cache
+CONDITIONAL_HEADERS = ('if-none-match', 'if-modified-since')
+CACHE_TTL = 24 * 60 * 60  # in seconds
+CACHE_SIZE = 200  # in MB
 
 
 def color(code):
@@ -79,66 +130,202 @@ def error(text, *args, **kwargs):
     sys.stdout.flush()
 
 
-class CompoundBar(ChargingBar):
+class Progress:
+    '''
+    Track the progress of many tasks without displaying anything.
+
+    Counters are updated by the tasks done callbacks
+    and only the running tasks and the last `window` failures are kept,
+    so tracking cost does not depend on the number of tasks.
+    '''
+    def __init__(self, message='', window=PROGRESS_WINDOW):
+        self.message = message
+        self.window = window
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.running = OrderedDict()
+        self.failures = deque(maxlen=window)
+        self.started = time.monotonic()
+
+    def add_task(self, label, coro):
+        spinner = Spinner(label, coro, self.on_done)
+        self.total += 1
+        self.running[spinner] = None
+        return spinner
+
+    def on_done(self, spinner):
+        self.done += 1
+        self.running.pop(spinner, None)
+        if not spinner.ok:
+            self.failed += 1
+            self.failures.append(spinner)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    async def track(self, coro):
+        '''Wait for the given coroutine to complete'''
+        return await coro
+
+
+class CompoundBar(Progress, ChargingBar):
+    '''
+    Display progress on a terminal: a progress bar
+    followed by the last `window` running tasks and failures,
+    redrawn in place every 0.1s.
+    '''
     suffix = '%(percent)d%% [%(index)d/%(max)d] (%(elapsed)ds)'
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, message='', window=PROGRESS_WINDOW, **kwargs):
+        Progress.__init__(self, message, window)
         self.lines = 0
-        self.max = 1
-        self.index = 0
-        self.tasks = []
-        super().__init__(*args, **kwargs)
+        self.height = 0
+        ChargingBar.__init__(self, message, **kwargs)
+
+    @property
+    def index(self):
+        return self.done
+
+    @index.setter
+    def index(self, value):
+        # Managed by Progress counters
+        pass
+
+    @property
+    def max(self):
+        return max(self.total, 1)
+
+    @max.setter
+    def max(self, value):
+        pass
 
-    # def __enter__(self):
+    @property
+    def elapsed(self):
+        return int(Progress.elapsed.fget(self))
 
     def up(self):
-        sys.stdout.write('\x1b[1A')
-        sys.stdout.flush()
+        if self.is_tty():
+            self.file.write('\x1b[1A')
         self.lines -= 1
 
     def down(self):
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+        if self.is_tty():
+            self.file.write('\n')
         self.lines += 1
 
     def top(self):
         while self.lines > 0:
             self.up()
 
+    def visible(self):
+        '''The last running tasks, then the last failures'''
+        running = list(itertools.islice(reversed(self.running), self.window))[::-1]
+        failures = list(self.failures)
+        return failures[max(0, len(failures) - self.window + len(running)):] + running
+
     def update(self):
         self.top()
-        self.max = len(self.tasks)
-        self.index = sum(1 for t in self.tasks if t.done)
         super().update()
-        for t in self.tasks:
+        lines = [str(spinner.spin()) for spinner in self.visible()]
+        # Clear lines left over from a previous, taller, display
+        self.height = max(self.height, len(lines))
+        lines.extend([''] * (self.height - len(lines)))
+        for line in lines:
             self.down()
-            self.writeln(t.spin())
-
-    def add_task(self, label, coro):
-        self.tasks.append(Spinner(label, coro))
-        self.update()
+            self.writeln(line)
 
-    async def wait(self):
-        while not all(t.done for t in self.tasks):
+    async def track(self, coro):
+        '''Display progress until the given coroutine completes'''
+        future = asyncio.ensure_future(coro)
+        while not future.done():
             self.update()
-            await asyncio.sleep(0.1)
+            await asyncio.wait([future], timeout=0.1)
         self.update()
         self.finish()
-        return self.results
+        return future.result()
 
-    @property
-    def results(self):
-        return [t.result for t in self.tasks]
+
+class JsonProgress(Progress):
+    '''
+    Report progress as JSON lines (ie. for CI logs):
+    counters every `interval` seconds and each failed task as soon as it fails.
+    '''
+    def __init__(self, message='', window=PROGRESS_WINDOW, interval=PROGRESS_INTERVAL):
+        super().__init__(message, window)
+        self.interval = interval
+
+    def emit(self, event, **data):
+        print(json.dumps({'event': event, 'message': self.message, **data}, ensure_ascii=False))
+        sys.stdout.flush()
+
+    def on_done(self, spinner):
+        super().on_done(spinner)
+        if spinner.error:
+            self.emit('error', label=spinner.label, error=spinner.error)
+
+    def report(self, event='progress'):
+        self.emit(event, done=self.done, total=self.total, failed=self.failed,
+                  elapsed=round(self.elapsed, 1))
+
+    async def track(self, coro):
+        future = asyncio.ensure_future(coro)
+        while not future.done():
+            await asyncio.wait([future], timeout=self.interval)
+            if not future.done():
+                self.report()
+        self.report('done')
+        return future.result()
+
+
+PROGRESS_MODES = {
+    'tty': CompoundBar,
+    'json': JsonProgress,
+    'quiet': Progress,
+}
+
+
+def progress_bar(message, mode='auto'):
+    '''
+    Get a progress tracker for the given mode:
+    `tty`, `json`, `quiet` or `auto` (`tty` on a terminal, `json` otherwise).
+    '''
+    if mode == 'auto':
+        mode = 'tty' if ChargingBar.file.isatty() else 'json'
+    if mode not in PROGRESS_MODES:
+        raise ValueError(f'Unknown progress mode {mode}')
+    return PROGRESS_MODES[mode](message)
+
+
+async def run_pool(jobs, bar, workers, on_result=None):
+    '''
+    Process `(label, coroutine)` jobs with a bounded pool of workers.
+
+    Jobs are consumed lazily so a coroutine is only created once a worker is free
+    and each result is handed to `on_result` then dropped as soon as it is available.
+    '''
+    async def worker():
+        for label, coro in jobs:
+            spinner = bar.add_task(label, coro)
+            await asyncio.wait([spinner.task])
+            if on_result is not None:
+                on_result(spinner.result)
+            # Only keep the outcome for display
+            spinner.result = None
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
 
 
 class Spinner:
     FRAMES = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']
 
-    def __init__(self, label, coro):
+    def __init__(self, label, coro, callback=None):
         self.label = label
         self.done = False
         self.result = None
         self.error = None
+        self.callback = callback
         self.frames = itertools.cycle(self.FRAMES)
         self.spin()
 
@@ -166,30 +353,571 @@ class Spinner:
             self.error = (str(e) or str(e.__class__.__name__)).split('\n')[0]
             self.result = {}
         else:
-            self.ok = self.result['found']
+            self.ok = self.result.get('found', True)
         self.done = True
         self.spin()
+        if self.callback is not None:
+            self.callback(self)
+
+
+class AdaptiveLimiter:
+    '''
+    An AIMD (Additive Increase, Multiplicative Decrease) concurrency limiter.
+
+    It behaves like a semaphore whose size grows by one each time
+    the p95 latency of a window of requests (one per slot, at least `window`)
+    stays close to the best observed one,
+    and is halved on congestion signals (429/503 responses, timeouts...),
+    pausing all acquisitions for the duration of a `Retry-After` if provided.
+
+    Slots are also acquired on the `parent` semaphore if any (ie. a global budget).
+    '''
+    TOLERANCE = 1.5  # Latency is considered flat below this factor of the baseline
+
+    def __init__(self, concurrency=CONCURRENCY, max_concurrency=MAX_CONCURRENCY,
+                 min_concurrency=1, window=10, parent=None):
+        self.limit = float(concurrency)
+        self.max_concurrency = max(max_concurrency, concurrency)
+        self.min_concurrency = min_concurrency
+        self.parent = parent
+        self.active = 0
+        self.waiters = deque()
+        self.window = window
+        self.latencies = []
+        self.baseline = None
+        self.paused_until = 0
+        self.last_backoff = 0
+        # Whether the limit has been reached since the last window
+        self.saturated = False
+        self.stats = Counter()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def locked(self):
+        return self.active >= self.concurrency or time.monotonic() < self.paused_until
+
+    async def acquire(self):
+        while self.locked():
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Woken up but cancelled: hand the slot to the next waiter
+                    self.wake()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.active += 1
+        if self.active >= self.concurrency:
+            self.saturated = True
+        if self.parent is not None:
+            try:
+                await self.parent.acquire()
+            except BaseException:
+                self.active -= 1
+                self.wake()
+                raise
+
+    def release(self):
+        self.active -= 1
+        if self.parent is not None:
+            self.parent.release()
+        self.wake()
+
+    def wake(self):
+        free = self.concurrency - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def record(self, latency):
+        '''Record a successful request latency and increase concurrency if latency is flat'''
+        self.latencies.append(latency)
+        if len(self.latencies) < max(self.window, self.concurrency):
+            return
+        p95 = percentile(sorted(self.latencies), 95)
+        self.latencies.clear()
+        saturated, self.saturated = self.saturated, False
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+        # Only grow when the limit is actually what bounds the throughput
+        if not saturated:
+            return
+        if p95 <= self.baseline * self.TOLERANCE and self.limit < self.max_concurrency:
+            self.limit = min(self.limit + 1, self.max_concurrency)
+            self.stats['increases'] += 1
+            self.wake()
+
+    def backoff(self, started, retry_after=None):
+        '''Decrease concurrency on a congestion signal from a request started at `started`'''
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        # Only back off once per congestion episode:
+        # requests started before the last backoff did not run with the decreased limit
+        if started < self.last_backoff:
+            return
+        self.last_backoff = now
+        self.limit = max(self.limit / 2, self.min_concurrency)
+        self.latencies.clear()
+        self.stats['backoffs'] += 1
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of some sorted values'''
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def retry_after(response):
+    '''Parse a `Retry-After` header as a delay in seconds'''
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now().astimezone()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, minimum=None):
+    '''Exponential backoff with full jitter'''
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, minimum or 0)
+
+
+class TrackedConnectionPool(httpx.ConnectionPool):
+    '''
+    A connection pool keeping track of connections reuse
+    and of the time spent establishing new connections (TCP and TLS handshakes).
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = Counter()
+        self.connect_time = 0
+
+    async def acquire_connection(self, origin):
+        connection = await super().acquire_connection(origin)
+        if connection.h11_connection is None and connection.h2_connection is None:
+            self.stats['new'] += 1
+            connection.connect = self.timed(connection)
+        else:
+            self.stats['reused'] += 1
+        return connection
+
+    def timed(self, connection):
+        connect = connection.connect
+
+        async def timed_connect(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                await connect(*args, **kwargs)
+            finally:
+                self.connect_time += time.monotonic() - start
+            self.stats['http2' if connection.is_http2 else 'http1'] += 1
+
+        return timed_connect
 
 
 class API:
-    def __init__(self, domain, scheme='http', timeout=TIMEOUT):
+    '''
+    A minimal udata API client.
+
+    Requests are performed within the `limiter` concurrency budget
+    and retried up to `retries` times with a jittered backoff
+    on timeouts, connection errors and 429/5xx transient responses.
+
+    Connections are kept alive in a pool sized to the limiter maximum concurrency
+    (HTTP/2 is negotiated when supported by the server).
+    Use it as an async context manager or call `close()` to release them.
+
+    Responses are recorded into or replayed from the `cassette` if any.
+    '''
+    def __init__(self, domain, scheme='http', timeout=TIMEOUT, limiter=None, retries=RETRIES,
+                 cassette=None):
         self.domain = domain
         self.scheme = scheme
         self.timeout = timeout
-        self.http = httpx.AsyncClient()
+        self.limiter = limiter or AdaptiveLimiter()
+        self.retries = retries
+        self.cassette = cassette
+        self.calls = 0
+        self.stats = Counter()
+        self.base_url = f'{scheme}://{domain}/api/'
+        size = self.limiter.max_concurrency
+        self.pool = TrackedConnectionPool(
+            timeout=timeout,
+            pool_limits=httpx.PoolLimits(soft_limit=size, hard_limit=size),
+        )
+        self.http = httpx.AsyncClient(dispatch=self.pool)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.http.close()
 
     def url_for(self, path, **params):
-        qs = urlencode(params, doseq=True)
-        if qs:
-            return f'{self.scheme}://{self.domain}/api/2/{path}search/?{qs}'
-        return f'{self.scheme}://{self.domain}/api/1/{path}'
+        if params:
+            return ''.join((self.base_url, '2/', path, 'search/?', urlencode(params, doseq=True)))
+        return ''.join((self.base_url, '1/', path))
 
-    async def get(self, path, **kwargs):
-        url = self.url_for(path, **kwargs.pop('params', {}))
+    async def fetch(self, path, **kwargs):
+        '''Perform a GET request on an API path and return the raw response (see `fetch_url`)'''
+        return await self.fetch_url(self.url_for(path, **kwargs.pop('params', {})), **kwargs)
+
+    async def fetch_url(self, url, **kwargs):
+        '''
+        Perform a GET request and return the raw response.
+
+        If a `timings` dict is given, it is filled with the time spent waiting
+        for the limiter (`wait`) and the successful request `latency` (in seconds).
+        '''
         timeout = kwargs.pop('timeout', self.timeout)
-        result = await self.http.get(url, timeout=timeout, **kwargs)
-        result.raise_for_status()
-        return result.json()
+        timings = kwargs.pop('timings', None)
+        if self.cassette and self.cassette.recording and 'headers' in kwargs:
+            # Record complete responses, whatever the local items cache state
+            kwargs['headers'] = {
+                name: value for name, value in kwargs['headers'].items()
+                if name.lower() not in CONDITIONAL_HEADERS
+            }
+        waited = 0
+        for attempt in range(self.retries + 1):
+            delay = None
+            queued = time.monotonic()
+            async with self.limiter:
+                self.calls += 1
+                start = time.monotonic()
+                waited += start - queued
+                try:
+                    response = await self.send(url, timeout, **kwargs)
+                except (httpx.exceptions.Timeout, ConnectionError) as e:
+                    if attempt >= self.retries:
+                        raise
+                    self.stats[e.__class__.__name__] += 1
+                    self.limiter.backoff(start)
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        latency = time.monotonic() - start
+                        self.limiter.record(latency)
+                        if timings is not None:
+                            timings.update(wait=waited, latency=latency)
+                        response.raise_for_status()
+                        return response
+                    if attempt >= self.retries:
+                        response.raise_for_status()
+                    self.stats[response.status_code] += 1
+                    delay = retry_after(response)
+                    self.limiter.backoff(start, delay)
+            self.stats['retries'] += 1
+            await asyncio.sleep(backoff_delay(attempt, delay))
+
+    async def send(self, url, timeout, **kwargs):
+        '''Perform a single GET request, through the cassette if any'''
+        if self.cassette and not self.cassette.recording:
+            return await self.cassette.replay(url, kwargs.get('headers'))
+        start = time.monotonic()
+        response = await self.http.get(url, timeout=timeout, **kwargs)
+        if self.cassette and response.status_code not in RETRY_STATUSES:
+            self.cassette.record(url, response, time.monotonic() - start)
+        return response
+
+    async def get(self, path, **kwargs):
+        response = await self.fetch(path, **kwargs)
+        # API responses are UTF-8 JSON, no need for charset detection
+        return json.loads(response.content)
+
+
+class ItemCache:
+    '''
+    A persistent items cache shared by all runs on a given domain.
+
+    Entries are stored in a single SQLite file, keyed by model and id
+    with their content hash and their `ETag`/`Last-Modified` validators.
+    Entries older than `ttl` seconds are revalidated before use
+    and least recently used entries are evicted when exceeding `max_size` bytes.
+    A `:memory:` path gives a cache private to its user.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS items (
+            model TEXT NOT NULL,
+            id TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            size INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            PRIMARY KEY (model, id)
+        )
+    '''
+
+    def __init__(self, path, ttl=CACHE_TTL, max_size=CACHE_SIZE * 1024 * 1024):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.SCHEMA)
+        self.stats = Counter()
+
+    def get(self, model, id):
+        '''Get a cache entry as a dict (or `None` if missing)'''
+        row = self.db.execute(
+            'SELECT hash, etag, last_modified, fetched_at, payload FROM items '
+            'WHERE model = ? AND id = ?', (model, id)
+        ).fetchone()
+        if row is None:
+            return None
+        hash, etag, last_modified, fetched_at, payload = row
+        return {
+            'hash': hash,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': time.time() - fetched_at < self.ttl,
+            'item': json.loads(zlib.decompress(payload).decode('utf-8')),
+        }
+
+    def put(self, model, id, item, etag=None, last_modified=None):
+        '''Store an item and return its content hash'''
+        content = serialize(item)
+        hash = content_hash(content)
+        payload = zlib.compress(content)
+        now = time.time()
+        self.db.execute(
+            'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (model, id, hash, etag, last_modified, now, now, len(payload), payload)
+        )
+        self.db.commit()
+        return hash
+
+    def touch(self, model, id, revalidated=False):
+        '''Mark an entry as recently used (and fresh if it has been revalidated)'''
+        now = time.time()
+        if revalidated:
+            self.db.execute('UPDATE items SET accessed_at = ?, fetched_at = ? '
+                            'WHERE model = ? AND id = ?', (now, now, model, id))
+        else:
+            self.db.execute('UPDATE items SET accessed_at = ? WHERE model = ? AND id = ?',
+                            (now, model, id))
+        self.db.commit()
+
+    @property
+    def size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM items').fetchone()[0]
+
+    def evict(self):
+        '''Evict the least recently used entries until the cache fits in `max_size`'''
+        excess = self.size - self.max_size
+        if excess <= 0:
+            return 0
+        evicted = []
+        rows = self.db.execute('SELECT model, id, size FROM items ORDER BY accessed_at')
+        for model, id, size in rows:
+            if excess <= 0:
+                break
+            evicted.append((model, id))
+            excess -= size
+        self.db.executemany('DELETE FROM items WHERE model = ? AND id = ?', evicted)
+        self.db.commit()
+        self.stats['evicted'] += len(evicted)
+        return len(evicted)
+
+    def close(self):
+        self.db.close()
+
+
+def serialize(item):
+    '''Serialize an item payload in a stable way'''
+    return json.dumps(item, ensure_ascii=False, sort_keys=True).encode('utf-8')
+
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class CassetteMiss(Exception):
+    '''A request has not been recorded in the replayed cassette'''
+
+
+class Cassette:
+    '''
+    Recorded API responses, for offline and deterministic runs.
+
+    In `record` mode, every final response (transient errors being retried)
+    is stored compressed in a single SQLite file indexed by URL,
+    with its status, headers and latency.
+    In `replay` mode, responses are served back from it
+    after their recorded latency multiplied by `latency` (immediately by default),
+    conditional requests being answered with a `304` when the `ETag` matches.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            latency REAL NOT NULL,
+            body BLOB NOT NULL
+        )
+    '''
+
+    def __init__(self, path, mode='replay', latency=0):
+        self.path = Path(path)
+        self.recording = mode == 'record'
+        self.latency = latency
+        if not self.recording and not self.path.exists():
+            raise FileNotFoundError(f'Unknown cassette {self.path}')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.SCHEMA)
+        self.stats = Counter()
+
+    def record(self, url, response, latency):
+        headers = json.dumps(list(response.headers.items()))
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                        (url, response.status_code, headers, latency,
+                         zlib.compress(response.content)))
+        self.db.commit()
+        self.stats['recorded'] += 1
+
+    async def replay(self, url, headers=None):
+        '''Serve a recorded response, raising `CassetteMiss` if there is none'''
+        row = self.db.execute('SELECT status, headers, latency, body FROM responses '
+                              'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            raise CassetteMiss(f'No recorded response for {url}')
+        status, response_headers, latency, body = row
+        if self.latency:
+            await asyncio.sleep(latency * self.latency)
+        response_headers = httpx.Headers(json.loads(response_headers))
+        etag = response_headers.get('etag')
+        if etag and headers and headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        else:
+            body = zlib.decompress(body)
+        self.stats['replayed'] += 1
+        return httpx.AsyncResponse(status, headers=response_headers, content=body,
+                                   request=httpx.AsyncRequest('GET', url))
+
+    def close(self):
+        self.db.close()
+
+
+class Scheduler:
+    '''
+    Share a requests concurrency budget between runners.
+
+    Each domain has its own concurrency cap
+    and all domains requests are bound by a global one.
+    '''
+    def __init__(self, concurrency=GLOBAL_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.domains = {}
+
+    def limiter(self, domain, concurrency=CONCURRENCY, max_concurrency=MAX_CONCURRENCY):
+        '''Get the (shared) adaptive limiter for a given domain'''
+        if domain not in self.domains:
+            self.domains[domain] = AdaptiveLimiter(concurrency, max_concurrency,
+                                                   parent=self.semaphore)
+        return self.domains[domain]
+
+
+class SearchMemo:
+    '''
+    A per-run memo of search results pages.
+
+    Identical searches (same model, normalized parameters and page)
+    share a single request, even while it is in flight.
+    Only the fields needed for ranking are kept, for the `size` most recent pages.
+    '''
+    def __init__(self, size=SEARCH_MEMO_SIZE):
+        self.size = size
+        self.pages = OrderedDict()
+        self.stats = Counter()
+
+    async def get(self, key, search):
+        '''
+        Get a search page, calling `search()` only if it is not known or in flight.
+
+        The request is cancelled (and forgotten) once all the queries waiting for it are.
+        '''
+        entry = self.pages.get(key)
+        if entry is None:
+            future = asyncio.ensure_future(self.fetch(search))
+            # Entries are `[future, waiters count]`
+            entry = self.pages[key] = [future, 0]
+            future.add_done_callback(lambda f: self.done(key, entry))
+            if len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(key)
+            self.stats['coalesced'] += 1
+        future = entry[0]
+        entry[1] += 1
+        try:
+            # Shielded as it may be shared by other queries
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not future.done():
+                future.cancel()
+                self.stats['cancelled'] += 1
+            raise
+        finally:
+            entry[1] -= 1
+
+    def done(self, key, entry):
+        '''Do not memoize failures, marking them as retrieved'''
+        future = entry[0]
+        if future.cancelled() or future.exception():
+            if self.pages.get(key) is entry:
+                del self.pages[key]
+
+    async def fetch(self, search):
+        result = await search()
+        if 'data' not in result:
+            return result
+        return {
+            'data': [
+                {k: v for k, v in item.items() if k in ('id', 'title', 'name')}
+                for item in result['data']
+            ],
+            'page_size': result['page_size'],
+            'total': result['total'],
+            'next_page': result.get('next_page'),
+        }
 
 
 class QueryResult:
@@ -208,6 +936,142 @@ class QueryResult:
             setattr(self, key, value)
 
 
+def ms(seconds):
+    '''Convert a duration in seconds into milliseconds (keeping `None`)'''
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def cancel_all(futures, stats):
+    '''Cancel pending futures, ignoring the outcome of the completed ones'''
+    for future in futures:
+        if not future.done():
+            future.cancel()
+            stats['cancelled'] += 1
+        elif not future.cancelled():
+            # Mark exceptions as retrieved
+            future.exception()
+
+
+def query_key(model, query, params, expected):
+    '''A stable key identifying a query (`params` being parsed)'''
+    if not params:
+        return (model, query, '{}', expected)
+    try:
+        # Parsed parameters values are lists, made hashable to be cached
+        encoded = encode_params(tuple(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in sorted(params.items())
+        ))
+    except TypeError:  # Unhashable parameters values
+        encoded = json.dumps(params, sort_keys=True)
+    return (model, query, encoded, expected)
+
+
+@lru_cache(maxsize=1024)
+def encode_params(items):
+    '''Serialize queries parameters, the same ones being shared by many queries'''
+    return json.dumps(dict(items), sort_keys=True)
+
+
+def result_key(result):
+    return query_key(result['model'], result['query'], result['params'], result['expected'])
+
+
+def shard_of(key, count):
+    '''The stable shard (from 0 to `count - 1`) of a query key'''
+    digest = hashlib.sha1(json.dumps(key, ensure_ascii=False).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def shard_root(base, run_id, index):
+    return base / 'shards' / run_id / str(index)
+
+
+def keyed_results(results):
+    '''
+    Iterate over `(key, result)` for all non-empty results,
+    duplicated queries being distinguished by their occurrence number.
+    '''
+    occurrences = {}
+    for result in results:
+        if not result:
+            continue
+        key = result_key(result)
+        count = occurrences[key] = occurrences.get(key, 0) + 1
+        yield key + (count,), result
+
+
+class Sampler:
+    '''
+    A deterministic stratified sampling of queries.
+
+    Queries are grouped into `strata`, by `model` and/or by their outcome
+    in a `baseline` run (`found-in-last-run`: found, not found or new),
+    and each stratum gets its proportional share of the sample `size`
+    so estimates computed on the sample need no reweighting.
+    Within a stratum, queries are picked in the order of their hash given the `seed`,
+    so the same queries are picked as long as the queries and the baseline do not change.
+    '''
+    STRATA = ('model', 'found-in-last-run')
+
+    def __init__(self, size, strata=('model',), seed=0, baseline=None):
+        unknown = set(strata) - set(self.STRATA)
+        if unknown:
+            raise ValueError('Unknown strata {0}'.format(', '.join(sorted(unknown))))
+        self.size = size
+        self.strata = list(strata)
+        self.seed = seed
+        self.baseline = baseline
+        self.population = 0
+        self.outcomes = {}
+        if baseline and 'found-in-last-run' in self.strata:
+            results = load_run(baseline)['queries']
+            self.outcomes = {key: result['found'] for key, result in keyed_results(results)}
+
+    def stratum(self, key):
+        stratum = []
+        if 'model' in self.strata:
+            stratum.append(key[0])
+        if 'found-in-last-run' in self.strata:
+            outcome = self.outcomes.get(key)
+            stratum.append('new' if outcome is None else 'found' if outcome else 'not-found')
+        return tuple(stratum)
+
+    def order(self, key):
+        return hashlib.sha1(json.dumps([self.seed, key]).encode('utf-8')).digest()
+
+    def select(self, keys):
+        '''Select the sample among the given (occurrence-numbered) query keys'''
+        strata = {}
+        for key in keys:
+            strata.setdefault(self.stratum(key), []).append(key)
+        self.population = sum(len(stratum) for stratum in strata.values())
+        size = min(self.size, self.population)
+        # Proportional allocation, remaining slots going to the largest remainders
+        quotas = {}
+        remainders = []
+        for name, stratum in strata.items():
+            share = size * len(stratum) / self.population
+            quotas[name] = int(share)
+            remainders.append((share - int(share), name))
+        for _, name in sorted(remainders, reverse=True)[:size - sum(quotas.values())]:
+            quotas[name] += 1
+        selected = set()
+        for name, stratum in strata.items():
+            stratum.sort(key=self.order)
+            selected.update(stratum[:quotas[name]])
+        return selected
+
+    def summary(self, selected):
+        return {
+            'size': len(selected),
+            'population': self.population,
+            'strata': self.strata,
+            'seed': self.seed,
+            'baseline': Path(self.baseline).parent.name if self.baseline else None,
+        }
+
+
 def row_label(row):
     if row['query'] and row['params']:
         return '{query} ({params})'
@@ -218,39 +1082,229 @@ def row_label(row):
 
 
 class Runner:
+    '''
+    Run every model benchmark against a given domain.
+
+    In `lean` mode, ranking only relies on the search payloads (id and title)
+    and full items payloads are fetched afterward in a single deduplicated stage
+    (or not at all if `fetch_items` is `False`).
+
+    In `speculative` mode, all the search pages of a query are requested concurrently
+    and those following the expected item are cancelled.
+
+    Runners sharing a `Scheduler` share its global concurrency budget.
+
+    Each model processes its queries with a pool of `workers`
+    and each result is appended to `queries.jsonl` as soon as it completes
+    while metrics are accumulated, so `queries.json` is streamed from it at the end.
+    If the run crashes, completed results are still available in `queries.jsonl`
+    and the run can be completed by giving its directory as `resume`.
+
+    API responses are recorded into or replayed from the `cassette` if any.
+    Queries are read from and results written to `data_dir`.
+    Progress is displayed according to the `progress` mode (see `progress_bar`).
+
+    A `shard` `(index, count)` only runs the queries whose key hashes to it (see `shard_of`),
+    writing a self-contained output (including its items)
+    into `data/<domain>/shards/<run_id>/<index>`,
+    to be merged with the other shards of the same `run_id`.
+
+    If `sample` is given, only a deterministic stratified sample of that many queries is run
+    (see `Sampler`), stratified by `strata` with the given `seed`.
+
+    Items are cached across runs in the domain `cache.sqlite`,
+    or for the run only when recording or replaying a `cassette`.
+    A warm `api` client and items `cache` can be given to be reused (see `Watcher`),
+    they are then left open once the run is complete.
+    '''
     def __init__(self, domain, max_pages=3, scheme='https', timeout=TIMEOUT,
-                 concurrency=CONCURRENCY):
+                 concurrency=CONCURRENCY, lean=False, fetch_items=True,
+                 cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, speculative=False,
+                 scheduler=None, max_concurrency=MAX_CONCURRENCY, retries=RETRIES,
+                 workers=WORKERS, resume=None, cassette=None, data_dir='data', progress='auto',
+                 shard=None, run_id=None, sample=None, strata=('model',), seed=0,
+                 api=None, cache=None):
         self.domain = domain
+        # Sampling settings, stored in the checkpoint to be resumed identically
+        self.sampling = {'size': sample, 'strata': list(strata), 'seed': seed} if sample else None
+        # The sampled queries keys (if sampling)
+        self.sample = None
+        self.sampler = None
+        self.shard = shard
+        self.run_id = run_id
+        self.progress = progress
+        self.data = Path(data_dir)
         self.scheme = scheme
-        self.api = API(domain, scheme, timeout)
+        self.scheduler = scheduler or Scheduler(max_concurrency)
+        # All models requests to a domain share the same limiter
+        self.limiter = self.scheduler.limiter(domain, concurrency, max_concurrency)
+        self.api = api or API(domain, scheme, timeout, self.limiter, retries, cassette)
+        # Recording or replaying, every item lookup goes through the cassette:
+        # items are only cached for the run, the domain cache being left untouched
+        cache_path = ':memory:' if cassette else self.base / 'cache.sqlite'
+        self.cache = cache or ItemCache(cache_path, cache_ttl, cache_size * 1024 * 1024)
+        self.owns_api = api is None
+        self.owns_cache = cache is None
         self.max_pages = max_pages
-        self.now = datetime.now()
+        # Shards directories are not named after their date, it is read from their checkpoint
+        if resume and not shard:
+            self.now = datetime.strptime(Path(resume).name, RUN_FORMAT)
+        else:
+            self.now = datetime.now()
+        self.resume = bool(resume)
+        # Completed queries keys count (when resuming)
+        self.done = Counter()
         self.concurrency = concurrency
-        self.runners = [DatasetRunner(self), OrgRunner(self)]
+        self.lean = lean
+        self.fetch_items = fetch_items
+        self.speculative = speculative
+        self.workers = workers
+        self.metrics = Metrics()
+        self.memo = SearchMemo()
+        self.stats = Counter()
+        self.runners = [DatasetRunner(self), OrgRunner(self), ReuseRunner(self)]
 
     @property
     def timestamp(self):
-        return self.now.isoformat(sep='-', timespec='minutes').replace(':', '-')
+        return self.now.strftime(RUN_FORMAT)
+
+    @property
+    def base(self):
+        return self.data / self.domain
 
     @property
     def root(self):
-        return Path('data') / self.domain / self.timestamp
+        if self.shard:
+            return shard_root(self.base, self.run_id, self.shard[0])
+        return self.base / self.timestamp
 
-    async def process(self):
-        self.root.mkdir(parents=True, exist_ok=True)
+    @property
+    def objects(self):
+        '''The content-addressed items store shared by all runs (or the shard own one)'''
+        if self.shard:
+            return self.root / 'objects'
+        return self.base / 'objects'
 
-        results = []
+    def baseline(self):
+        '''The latest complete full (neither sampled nor replayed) run results file (if any)'''
+        runs = [path for path in full_run_files(self.base) if path.parent != self.root]
+        return str(runs[-1]) if runs else None
 
-        for runner in self.runners:
-            results.extend(await runner.process())
+    def in_shard(self, key):
+        '''Wether a query belongs to this run'''
+        return self.shard is None or shard_of(key, self.shard[1]) == self.shard[0] - 1
 
-        data = compile_results('{scheme}://{domain}'.format(**self.__dict__), self.now, results)
+    @property
+    def server(self):
+        return '{scheme}://{domain}'.format(**self.__dict__)
 
+    async def process(self, bar=None):
+        '''
+        Run all models concurrently.
+
+        Progress is displayed on the given `bar` if any (ie. when shared by many runners).
+        '''
+        if bar is None:
+            bar = progress_bar(f'Querying {self.domain}', self.progress)
+            return await bar.track(self.process(bar))
+
+        try:
+            return await self.execute(bar)
+        finally:
+            if self.owns_api:
+                await self.api.close()
+            if self.owns_cache:
+                self.cache.close()
+
+    async def execute(self, bar):
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+        if self.resume:
+            self.load_checkpoint()
+        else:
+            if self.sampling:
+                self.sampling['baseline'] = self.baseline()
+            with self.checkpoint_file.open('w', encoding='utf-8') as jsonfile:
+                json.dump({'date': self.now.timestamp(), 'sampling': self.sampling}, jsonfile)
+        if self.sampling:
+            self.sampler = Sampler(**self.sampling)
+            self.sample = self.sampler.select(itertools.chain.from_iterable(
+                runner.keys() for runner in self.runners
+            ))
+
+        with self.results_file.open('a', encoding='utf-8') as self.output:
+            await asyncio.gather(*(runner.process(bar) for runner in self.runners))
+
+        # Each run only references the items it used in the shared store
+        manifest = {runner.basename: runner.manifest for runner in self.runners}
+        with (self.root / 'items.json').open('w', encoding='utf-8') as jsonfile:
+            json.dump(manifest, jsonfile, sort_keys=True)
+
+        self.cache.evict()
+
+        header = self.metrics.summary(self.server, self.now)
+        if self.shard:
+            header.update(run_id=self.run_id, shard='{0}/{1}'.format(*self.shard))
+        if self.sampler:
+            header['sample'] = self.sampler.summary(self.sample)
+        if self.api.cassette and not self.api.cassette.recording:
+            header['replay'] = str(self.api.cassette.path)
         outfile = self.root / 'queries.json'
-        with outfile.open('w', encoding='utf-8') as jsonfile:
-            json.dump(data, jsonfile, ensure_ascii=False)
+        with self.results_file.open(encoding='utf-8') as lines:
+            with atomic_write(outfile, encoding='utf-8') as jsonfile:
+                dump_results(jsonfile, header, lines)
+        self.results_file.unlink()
+        self.checkpoint_file.unlink()
 
-        return results
+    @property
+    def results_file(self):
+        '''Line-delimited results, appended as soon as they are available'''
+        return self.root / 'queries.jsonl'
+
+    @property
+    def checkpoint_file(self):
+        '''The run metadata needed to resume it'''
+        return self.root / 'checkpoint.json'
+
+    def load_checkpoint(self):
+        '''
+        Load the results already completed by an interrupted run.
+
+        Failed queries and a partially written last result are dropped from the checkpoint
+        so their queries are run again.
+        '''
+        with self.checkpoint_file.open(encoding='utf-8') as jsonfile:
+            checkpoint = json.load(jsonfile)
+        self.now = datetime.fromtimestamp(checkpoint['date'])
+        self.sampling = checkpoint.get('sampling')
+        if not self.results_file.exists():
+            return
+        models = {runner.model: runner for runner in self.runners}
+        checkpoint = self.results_file.with_suffix('.tmp')
+        with self.results_file.open(encoding='utf-8') as lines:
+            with checkpoint.open('w', encoding='utf-8') as output:
+                for line in lines:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        break
+                    if not result:
+                        continue
+                    output.write(line)
+                    self.metrics.add(result)
+                    self.done[result_key(result)] += 1
+                    # Ensure items from completed queries are referenced by the run
+                    runner = models[result['model']]
+                    runner.seen.add(result['expected'])
+                    runner.seen.update(item['id'] for item in result['items'])
+        checkpoint.replace(self.results_file)
+        self.stats['resumed'] = self.metrics.total
+
+    def record(self, result):
+        self.output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        self.output.flush()
+        self.metrics.add(result)
 
 
 class ModelRunnner:
@@ -260,56 +1314,153 @@ class ModelRunnner:
 
     def __init__(self, runner):
         self.runner = runner
-        # Manage concurrency with an async Semaphore
-        self.limiter = asyncio.Semaphore(runner.concurrency)
+        # Items seen in search results while ranking in lean mode
+        self.seen = set()
+        # Content hashes of the items used during this run, by id
+        self.manifest = {}
+        # Items being fetched, to avoid concurrent requests for the same item
+        self.pending = {}
+        # Items requests performed by this model
+        self.fetched = 0
 
     @property
     def api(self):
         return self.runner.api
 
     @property
-    def files(self):
-        return self.runner.root / self.basename
-
-    async def process(self):
-        self.files.mkdir(parents=True, exist_ok=True)
-
-        with open(f'data/{self.basename}.csv', newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            bar = CompoundBar(f'Querying {self.basename}')
-            for row in reader:
-                bar.add_task(row_label(row),
-                             self.process_query(row['query'], row['params'], row['expected']))
-
-        return await bar.wait()
-
-    async def get_item(self, id):
-        item_file = self.files / f'{id}.json'
-        if item_file.exists():
-            with item_file.open(encoding='utf-8') as jsonfile:
-                item = json.load(jsonfile)
+    def cache(self):
+        return self.runner.cache
+
+    def label(self, text):
+        return f'{self.runner.domain} › {self.basename} › {text}'
+
+    async def process(self, bar):
+        with self.csv_file.open(newline='', encoding='utf-8') as csvfile:
+            jobs = (
+                (self.label(row_label(row)),
+                 self.process_query(row['query'], row['params'], row['expected']))
+                for row in self.remaining(csv.DictReader(csvfile))
+            )
+            await run_pool(jobs, bar, self.runner.workers, self.runner.record)
+
+        # Seen items are either lean ranking ones or those of resumed queries
+        if self.runner.fetch_items:
+            await self.fetch_seen_items(bar)
         else:
-            item = await self.get(id)
-            with item_file.open('w', encoding='utf-8') as jsonfile:
-                json.dump(item, jsonfile, ensure_ascii=False)
+            self.runner.stats['items_skipped'] += len(self.seen.difference(self.manifest))
 
+    @property
+    def csv_file(self):
+        return self.runner.data / f'{self.basename}.csv'
+
+    def row_key(self, row):
+        return query_key(self.model, row['query'], parse_qs(row['params']), row['expected'])
+
+    def keys(self):
+        '''All the queries keys, numbered by occurrence (see `keyed_results`)'''
+        occurrences = Counter()
+        with self.csv_file.open(newline='', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                key = self.row_key(row)
+                occurrences[key] += 1
+                yield key + (occurrences[key],)
+
+    def remaining(self, rows):
+        '''
+        Filter out rows from other shards, not sampled
+        or already completed (when resuming)
+        '''
+        done = self.runner.done
+        sample = self.runner.sample
+        occurrences = Counter()
+        for row in rows:
+            key = self.row_key(row)
+            occurrences[key] += 1
+            if sample is not None and key + (occurrences[key],) not in sample:
+                continue
+            if not self.runner.in_shard(key):
+                continue
+            if done[key] > 0:
+                done[key] -= 1
+                continue
+            yield row
+
+    async def fetch_seen_items(self, bar):
+        '''Fetch all items seen while ranking in a single deduplicated batch'''
+        missing = [id for id in sorted(self.seen) if id not in self.manifest]
+        self.runner.stats['items_batched'] += len(missing)
+        fetched = self.fetched
+        jobs = ((self.label(id), self.get_item(id)) for id in missing)
+        await run_pool(jobs, bar, self.runner.workers)
+        # Cached items are looked up without any request
+        self.runner.stats['items_batch_fetched'] += self.fetched - fetched
+
+    async def get_item(self, id, timings=None):
+        '''
+        Get an item from the persistent cache,
+        revalidating or fetching it if needed,
+        and reference it in the current run.
+
+        `timings` are filled only if this call performs the request.
+        '''
+        if id not in self.pending:
+            self.pending[id] = asyncio.ensure_future(self.resolve_item(id, timings))
+            self.pending[id].add_done_callback(lambda f: self.pending.pop(id, None))
+        return await asyncio.shield(self.pending[id])
+
+    async def resolve_item(self, id, timings=None):
+        entry = self.cache.get(self.model, id)
+        if entry and (entry['fresh'] or entry['hash'] == self.manifest.get(id)):
+            self.cache.touch(self.model, id)
+            self.cache.stats['hits'] += 1
+            item, hash = entry['item'], entry['hash']
+        else:
+            headers = {}
+            if entry and entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry and entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            response = await self.fetch(id, headers=headers, timings=timings)
+            self.runner.stats['items_fetched'] += 1
+            self.fetched += 1
+            if entry and response.status_code == 304:
+                self.cache.touch(self.model, id, revalidated=True)
+                self.cache.stats['revalidated'] += 1
+                item, hash = entry['item'], entry['hash']
+            else:
+                item = json.loads(response.content)
+                hash = self.cache.put(self.model, id, item,
+                                      etag=response.headers.get('etag'),
+                                      last_modified=response.headers.get('last-modified'))
+                self.cache.stats['misses'] += 1
+
+        self.store(hash, item)
+        self.manifest[id] = hash
         return item
 
+    def store(self, hash, item):
+        '''Write an item into the content-addressed store if not already present'''
+        item_file = self.runner.objects / f'{hash}.json'
+        if not item_file.exists():
+            with item_file.open('wb') as jsonfile:
+                jsonfile.write(serialize(item))
+
     async def process_query(self, query, params, expected):
         params = parse_qs(params)
-        async with self.limiter:
-            try:
-                item = await self.get_item(expected)
-            except httpx.exceptions.HttpError as e:
-                item = {'title': f'{self.model}({expected}) injoignable'}
-                result = QueryResult(error=f'Impossible de récupérer {self.model}:\n{e}',
-                                     found=False)
-            except Exception as e:
-                item = {'title': f'{self.model}({expected}) injoignable'}
-                result = QueryResult(error=f'Erreur inconnue:\n{e}',
-                                     found=False)
-            else:
-                result = await self.rank_query(query, params, expected)
+        item_timings = {}
+        search_timings = []
+        try:
+            item = await self.get_item(expected, item_timings)
+        except httpx.exceptions.HttpError as e:
+            item = {'title': f'{self.model}({expected}) injoignable'}
+            result = QueryResult(error=f'Impossible de récupérer {self.model}:\n{e}',
+                                 found=False)
+        except Exception as e:
+            item = {'title': f'{self.model}({expected}) injoignable'}
+            result = QueryResult(error=f'Erreur inconnue:\n{e}',
+                                 found=False)
+        else:
+            result = await self.rank_query(query, params, expected, search_timings)
 
         return {
             'uid': result.uid,
@@ -324,20 +1475,74 @@ class ModelRunnner:
             'page': result.page,
             'items': result.items,
             'error': result.error,
+            'timings': {
+                'wait': ms(item_timings.get('wait', 0)
+                           + sum(timings['wait'] for timings in search_timings)),
+                'item': ms(item_timings.get('latency')),
+                'search': [ms(timings['latency']) for timings in search_timings],
+            },
         }
 
-    async def rank_query(self, query, params, expected):
+    async def rank_query(self, query, params, expected, timings=None):
+        '''
+        Rank the expected item among the query search pages,
+        appending the timings of each page request this query performed to `timings` if given.
+        '''
+        pages = range(1, self.runner.max_pages + 1)
+        pages_timings = [{} for page in pages]
+        try:
+            if self.runner.speculative:
+                # Request all pages upfront, pages after the expected one are cancelled on return
+                searches = [
+                    asyncio.ensure_future(self.request_page(query, params, page, page_timings))
+                    for page, page_timings in zip(pages, pages_timings)
+                ]
+                try:
+                    return await self.rank_pages(searches, expected)
+                finally:
+                    cancel_all(searches, self.runner.stats)
+            else:
+                searches = (self.request_page(query, params, page, page_timings)
+                            for page, page_timings in zip(pages, pages_timings))
+                return await self.rank_pages(searches, expected)
+        finally:
+            if timings is not None:
+                # Pages shared with other queries are only timed for the one requesting them
+                timings.extend(page_timings for page_timings in pages_timings if page_timings)
+
+    async def request_page(self, query, params, page, timings=None):
+        '''
+        Get a search page through the run memo, sharing identical searches.
+
+        `timings` are filled only if this call performs the request.
+        '''
+        normalized = {**params, 'q': query} if query else params
+        key = (self.model, json.dumps(normalized, sort_keys=True), page)
+        return await self.runner.memo.get(
+            key, lambda: self.search_page(query, params, page, timings)
+        )
+
+    async def search_page(self, query, params, page, timings=None):
+        result = await self.search(query, params, page=page, timings=timings)
+        self.runner.stats['searches'] += 1
+        return result
+
+    async def rank_pages(self, searches, expected):
+        '''Rank the expected item given the (awaitable) search pages in order'''
         items = []
-        page = 1
         rank = 0
-        while page <= self.runner.max_pages:
-            result = await self.search(query, params, page=page)
+        for page, search in enumerate(searches, 1):
+            result = await search
             if 'data' not in result:
                 return QueryResult(error=f'Mauvais format de réponse:\n{result}',
                                    page=page,
                                    items=items)
             for rank, item in enumerate(result['data'], rank + 1):
-                item = await self.get_item(item['id'])
+                self.runner.stats['hits'] += 1
+                if self.runner.lean:
+                    self.seen.add(item['id'])
+                else:
+                    item = await self.get_item(item['id'])
                 items.append({'id': item['id'], 'title': item.get('title', item.get('name'))})
                 if item['id'] == expected:
                     return QueryResult(found=True,
@@ -351,12 +1556,15 @@ class ModelRunnner:
                                    page_size=result['page_size'],
                                    items=items,
                                    total=result['total'])
-            page += 1
 
     async def get(self, id):
+        response = await self.fetch(id)
+        return json.loads(response.content)
+
+    async def fetch(self, id, **kwargs):
         raise NotImplementedError()
 
-    async def search(self, query, params, page=1):
+    async def search(self, query, params, page=1, **kwargs):
         raise NotImplementedError()
 
 
@@ -364,118 +1572,1173 @@ class DatasetRunner(ModelRunnner):
     model = 'Dataset'
     basename = 'datasets'
 
-    async def get(self, id):
-        return await self.api.get('datasets/{0}/'.format(id))
+    async def fetch(self, id, **kwargs):
+        return await self.api.fetch('datasets/{0}/'.format(id), **kwargs)
 
-    async def search(self, query, params, page=1):
+    async def search(self, query, params, page=1, **kwargs):
         params = {'page': page, 'page_size': PAGE_SIZE, **params}
         if query:
             params['q'] = query
-        return await self.api.get('datasets/', params=params)
+        return await self.api.get('datasets/', params=params, **kwargs)
 
 
 class OrgRunner(ModelRunnner):
     model = 'Organization'
     basename = 'organizations'
 
-    async def get(self, id):
-        return await self.api.get('organizations/{0}/'.format(id))
+    async def fetch(self, id, **kwargs):
+        return await self.api.fetch('organizations/{0}/'.format(id), **kwargs)
 
-    async def search(self, query, params, page=1):
+    async def search(self, query, params, page=1, **kwargs):
         params = {'page': page, 'page_size': PAGE_SIZE, **params}
         if query:
             params['q'] = query
-        return await self.api.get('organizations/', params=params)
+        return await self.api.get('organizations/', params=params, **kwargs)
 
 
-def count_found(results):
-    return sum(1 for r in results if r and r['found'])
+class ReuseRunner(ModelRunnner):
+    model = 'Reuse'
+    basename = 'reuses'
 
+    async def fetch(self, id, **kwargs):
+        return await self.api.fetch('reuses/{0}/'.format(id), **kwargs)
 
-def count_errors(results):
-    return sum(1 for r in results if r and r.get('error'))
+    async def search(self, query, params, page=1, **kwargs):
+        params = {'page': page, 'page_size': PAGE_SIZE, **params}
+        if query:
+            params['q'] = query
+        return await self.api.get('reuses/', params=params, **kwargs)
+
+
+class Watcher:
+    '''
+    Run a domain benchmark on schedule, in a long-lived process.
+
+    The API client (and its connections), its concurrency limiter and the items cache
+    are kept warm from one run to the next while each run gets its own search memo
+    (searches results must be fresh to be measured).
+    Each run starts at its period slot plus a random delay of up to `jitter` times the period
+    so that watchers started together do not hit the server at once,
+    slots missed by a run longer than the period being skipped.
+    The TOC is updated incrementally after each run
+    and the watcher status (with the last run timings) is served as JSON
+    on `http://127.0.0.1:<status_port>/` (unless `status_port` is 0).
+
+    Other `options` are given to each `Runner`.
+    '''
+    def __init__(self, domain, every, jitter=WATCH_JITTER, status_port=STATUS_PORT, pack=False,
+                 max_pages=3, scheme='https', timeout=TIMEOUT, concurrency=CONCURRENCY,
+                 max_concurrency=MAX_CONCURRENCY, retries=RETRIES,
+                 cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, **options):
+        self.domain = domain
+        self.every = every
+        self.jitter = jitter
+        self.status_port = status_port
+        self.pack = pack
+        self.max_pages = max_pages
+        self.scheme = scheme
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.options = options
+        self.scheduler = Scheduler(max_concurrency)
+        self.limiter = self.scheduler.limiter(domain, concurrency, max_concurrency)
+        self.api = API(domain, scheme, timeout, self.limiter, retries)
+        self.cache = ItemCache(Path('data') / domain / 'cache.sqlite', cache_ttl,
+                               cache_size * 1024 * 1024)
+        self.index = None
+        self.random = random.Random()
+        self.status = {
+            'domain': domain,
+            'every': every,
+            'pid': os.getpid(),
+            'started': isoformat(time.time()),
+            'state': 'starting',
+            'next_run': None,
+            'runs': 0,
+            'failures': 0,
+            'last': None,
+        }
 
+    async def watch(self, runs=None):
+        '''Run benchmarks on schedule, forever or `runs` times'''
+        server = None
+        if self.status_port:
+            server = await asyncio.start_server(self.handle_status, '127.0.0.1', self.status_port)
+        try:
+            slot = time.time()
+            while runs is None or self.status['runs'] < runs:
+                start = slot + self.random.uniform(0, self.jitter * self.every)
+                self.status.update(state='waiting', next_run=isoformat(start))
+                info('Next run at {0}', self.status['next_run'])
+                await asyncio.sleep(max(start - time.time(), 0))
+                await self.run()
+                slot += self.every * (math.floor((time.time() - slot) / self.every) + 1)
+        finally:
+            if server:
+                server.close()
+                await server.wait_closed()
+            await self.api.close()
+            self.cache.close()
+
+    async def run(self):
+        runner = Runner(self.domain, self.max_pages, self.scheme, self.timeout, self.concurrency,
+                        scheduler=self.scheduler, max_concurrency=self.max_concurrency,
+                        api=self.api, cache=self.cache, **self.options)
+        self.status.update(state='running', next_run=None)
+        calls = self.api.calls
+        connections = Counter(self.api.pool.stats)
+        started = time.time()
+        start = time.monotonic()
+        header('Running benchmark {0} on {1}', runner.timestamp, self.domain)
+        try:
+            await runner.process()
+        except Exception as e:
+            self.status['failures'] += 1
+            self.status['last'] = {'run': runner.timestamp, 'started': isoformat(started),
+                                   'error': str(e)}
+            error('Run {0} failed: {1}', runner.timestamp, e)
+            return
+        finally:
+            self.status['runs'] += 1
+        duration = time.monotonic() - start
+        if self.pack:
+            pack_run(runner.root)
+        self.index, _ = write_toc(self.domain, self.index)
+        metrics = runner.metrics
+        self.status['last'] = {
+            'run': runner.timestamp,
+            'started': isoformat(started),
+            'duration': round(duration, 3),
+            'queries': metrics.total,
+            'found': metrics.found,
+            'errors': metrics.errors,
+            'score': metrics.score,
+            'http_calls': self.api.calls - calls,
+            'connections': dict(Counter(self.api.pool.stats) - connections),
+            'concurrency': self.limiter.concurrency,
+            'latency': metrics.latency,
+        }
+        success('Run {0}: {1} queries in {2:.1f}s, {3} HTTP calls, {4} new connections',
+                runner.timestamp, metrics.total, duration, self.status['last']['http_calls'],
+                self.status['last']['connections'].get('new', 0))
 
-def average_rank(results):
-    ranks = [r['rank'] for r in results if r and r['found']]
-    return sum(ranks) / float(len(ranks))
+    async def handle_status(self, reader, writer):
+        '''Serve the watcher status as JSON (a minimal HTTP/1.1 server)'''
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.split()
+            if len(parts) > 1 and parts[1] in (b'/', b'/status'):
+                status, body = '200 OK', json.dumps(self.status, ensure_ascii=False)
+            else:
+                status, body = '404 Not Found', json.dumps({'error': 'Not found'})
+            body = body.encode('utf-8')
+            head = (f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                    f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n')
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds')
+
+
+class Histogram:
+    '''
+    A log-scale histogram of durations (in milliseconds),
+    percentiles being estimated within `GROWTH` relative precision.
+    '''
+    GROWTH = 1.1
+    MINIMUM = 0.1
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        # Durations below the minimum fall in the bucket -1
+        bucket = -1
+        if value >= self.MINIMUM:
+            bucket = int(math.log(value / self.MINIMUM, self.GROWTH))
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        '''The upper bound of the bucket containing the `p` percentile'''
+        threshold = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                return round(self.MINIMUM * self.GROWTH ** (bucket + 1), 1) if bucket >= 0 else 0
+        return None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            **{f'p{p}': self.percentile(p) for p in LATENCY_PERCENTILES},
+        }
 
 
-def ranks(results):
-    ranks = [r['rank'] if r and r['found'] else 0 for r in results]
-    out = [0] * (max(ranks) + 1)
-    for result in results:
+class Metrics:
+    '''
+    A run aggregated metrics, accumulated in a single pass (O(1) per result).
+
+    - `total`: the number of queries
+    - `found`: the number of queries whose expected item has been found
+    - `avg_rank`: the average rank of found items
+    - `ranks`: the number of found items by rank
+    - `errors`: the number of failed queries
+    - `score`: the average rank weighted by the found ratio
+    - `latency`: each model `search` (by page), `item` and limiter `wait`
+      durations percentiles (in milliseconds)
+    - `confidence`: the `found` rate, `avg_rank` and `score` confidence intervals
+      (at `CONFIDENCE_LEVEL`), meaningful when the queries are a sample of a larger set
+    '''
+    def __init__(self, results=None):
+        self.total = 0
+        self.found = 0
+        self.errors = 0
+        self.rank_sum = 0
+        self.rank_squares = 0
+        self.ranks = [0]
+        self.latencies = {}
+        for result in results or []:
+            self.add(result)
+
+    def add(self, result):
+        self.total += 1
+        if result and result.get('timings'):
+            self.add_timings(result['model'], result['timings'])
+        if result and result.get('error'):
+            self.errors += 1
         if result and result['found']:
-            out[result['rank']] += 1
-    return out
+            rank = result['rank']
+            self.found += 1
+            self.rank_sum += rank
+            self.rank_squares += rank * rank
+            if rank >= len(self.ranks):
+                self.ranks.extend([0] * (rank + 1 - len(self.ranks)))
+            self.ranks[rank] += 1
+
+    def add_timings(self, model, timings):
+        if model not in self.latencies:
+            self.latencies[model] = {name: Histogram() for name in ('search', 'item', 'wait')}
+        histograms = self.latencies[model]
+        for latency in timings['search']:
+            histograms['search'].add(latency)
+        if timings['item'] is not None:
+            histograms['item'].add(timings['item'])
+        histograms['wait'].add(timings['wait'])
 
+    @property
+    def avg_rank(self):
+        return self.rank_sum / float(self.found) if self.found else None
+
+    @property
+    def confidence(self):
+        '''
+        Wilson score interval for the found rate, normal approximation intervals
+        for the average rank (over found queries) and the score (over all queries)
+        '''
+        z = CONFIDENCE_Z
+        intervals = {'level': CONFIDENCE_LEVEL, 'found': None, 'avg_rank': None, 'score': None}
+        if not self.total:
+            return intervals
+        n = self.total
+        rate = self.found / n
+        center = (rate + z * z / (2 * n)) / (1 + z * z / n)
+        margin = z * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        intervals['found'] = [center - margin, center + margin]
+        # The score is the mean rank over all queries, counting 0 for not found ones
+        intervals['score'] = mean_interval(self.rank_sum, self.rank_squares, n, z)
+        if self.found:
+            intervals['avg_rank'] = mean_interval(self.rank_sum, self.rank_squares, self.found, z)
+        return intervals
+
+    @property
+    def latency(self):
+        return {
+            model: {name: histogram.summary() for name, histogram in histograms.items()}
+            for model, histograms in sorted(self.latencies.items())
+        }
 
-def score(results):
-    return (average_rank(results) * count_found(results)) / len(results)
+    @property
+    def score(self):
+        return (self.avg_rank * self.found) / self.total if self.found else 0
+
+    def summary(self, server, timestamp):
+        '''The run header, ie. all fields but the queries'''
+        return {
+            'total': self.total,
+            'found': self.found,
+            'avg_rank': self.avg_rank,
+            'ranks': self.ranks,
+            'errors': self.errors,
+            'score': self.score,
+            'confidence': self.confidence,
+            'latency': self.latency,
+            'date': timestamp.isoformat(timespec='seconds'),
+            'server': server,
+            'metrics': metrics_version(),
+        }
+
+
+def mean_interval(total, squares, count, z):
+    '''A normal approximation confidence interval of a mean given its sums of values and squares'''
+    mean = total / count
+    variance = max(squares - count * mean * mean, 0) / (count - 1) if count > 1 else 0
+    margin = z * math.sqrt(variance / count)
+    return [mean - margin, mean + margin]
 
 
 def compile_results(server, timestamp, results):
     return {
-        'total': len(results),
-        'found': count_found(results),
-        'avg_rank': average_rank(results),
-        'ranks': ranks(results),
-        'errors': count_errors(results),
-        'score': score(results),
+        **Metrics(results).summary(server, timestamp),
         'queries': results,
-        'date': timestamp.isoformat(timespec='seconds'),
-        'server': server
     }
 
 
+def metrics_version():
+    '''A hash of the metrics computation code, stored with the results it computed'''
+    global _metrics_version
+    if _metrics_version is None:
+        source = ''.join(inspect.getsource(code)
+                         for code in (Histogram, Metrics, mean_interval, compile_results))
+        _metrics_version = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+    return _metrics_version
+
+
+_metrics_version = None
+
+
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    '''Write a file through a temporary file renamed on success'''
+    path = Path(path)
+    tmp = path.with_name(f'.{path.name}.tmp')
+    try:
+        with tmp.open(mode, **kwargs) as output:
+            yield output
+        tmp.replace(path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def dump_results(jsonfile, header, lines):
+    '''
+    Write a run results as JSON, streaming its queries
+    from some JSON-serialized `lines` after the `header` fields.
+    '''
+    jsonfile.write(json.dumps(header, ensure_ascii=False)[:-1])
+    jsonfile.write(', "queries": [' if header else '"queries": [')
+    for index, line in enumerate(lines):
+        if index:
+            jsonfile.write(', ')
+        jsonfile.write(line.rstrip('\n'))
+    jsonfile.write(']}')
+
+
+def read_header(filename):
+    '''
+    Read a run `queries.json` fields but its `queries` without decoding them.
+
+    Only the beginning (and the end, for older runs storing fields after the queries)
+    of the file are read, or the header of a packed run archive.
+    '''
+    if Path(filename).name == PACK_FILE:
+        return RunPack(filename).header()
+    marker = b'"queries": ['
+    with open(filename, 'rb') as jsonfile:
+        head = b''
+        while marker not in head[-HEADER_CHUNK - len(marker):]:
+            chunk = jsonfile.read(HEADER_CHUNK)
+            if not chunk:
+                raise ValueError(f'No queries in {filename}')
+            head += chunk
+        jsonfile.seek(0, os.SEEK_END)
+        jsonfile.seek(max(jsonfile.tell() - HEADER_CHUNK, 0))
+        tail = jsonfile.read()
+    fields = json.loads(head[:head.index(marker)].rstrip().rstrip(b',') + b'}')
+    trailing = tail[tail.rindex(b']') + 1:].strip()
+    if trailing.startswith(b','):
+        fields.update(json.loads(b'{' + trailing[1:]))
+    return fields
+
+
+def precompress(path, content=None):
+    '''
+    Write the static `.gz` (and `.br` if brotli is available) siblings of a file
+    for web servers and the dashboard to serve them compressed.
+
+    The file itself may not exist if its `content` is given.
+    '''
+    path = Path(path)
+    if content is None:
+        content = path.read_bytes()
+    with atomic_write(path.with_name(path.name + '.gz'), 'wb') as output:
+        # Reproducible output: no file name nor modification time in the header
+        with gzip.GzipFile('', 'wb', 9, output, mtime=0) as gzfile:
+            gzfile.write(content)
+    if brotli:
+        with atomic_write(path.with_name(path.name + '.br'), 'wb') as output:
+            output.write(brotli.compress(content))
+
+
+def run_files(base):
+    '''A domain runs results files, their `queries.json` or their archive if packed'''
+    base = Path(base)
+    plain = set(base.glob('*/queries.json'))
+    packed = [path for path in base.glob(f'*/{PACK_FILE}')
+              if path.with_name('queries.json') not in plain]
+    return sorted([*plain, *packed])
+
+
+def is_full_run(header):
+    '''Whether a run queried all the queries live (neither sampled nor replayed)'''
+    return not (header.get('sample') or header.get('replay'))
+
+
+def full_run_files(base):
+    '''A domain full runs results files, sampled and replayed runs being left out'''
+    return [path for path in run_files(base) if is_full_run(read_header(path))]
+
+
+def load_run(filename):
+    '''Load a run results, packed or not'''
+    filename = Path(filename)
+    if filename.name == PACK_FILE:
+        return RunPack(filename).load()
+    with filename.open(encoding='utf-8') as jsonfile:
+        return json.load(jsonfile)
+
+
+class RunPack:
+    '''
+    A run packed into a single compressed archive (a zip file).
+
+    - `header.json`: the run fields but its queries
+    - `strings.json`: the table of the strings repeated across queries (items ids and titles)
+    - `queries.json`: the queries, their `items` as `[id, title]` indexes in the string table
+    - `items/<model>/<id>.json`: each item payload, accessed randomly by id
+
+    A `pack.json` index of the items compressed data offsets and lengths in the archive
+    and `queries.json.gz` and `.br` files for the dashboard are written alongside.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def header(self):
+        with zipfile.ZipFile(self.path) as archive:
+            return json.loads(archive.read('header.json'))
+
+    def load(self):
+        '''The run results, as they would be in its `queries.json`'''
+        with zipfile.ZipFile(self.path) as archive:
+            data = json.loads(archive.read('header.json'))
+            strings = json.loads(archive.read('strings.json'))
+            queries = json.loads(archive.read('queries.json'))
+        for result in queries:
+            if result and result.get('items'):
+                result['items'] = [{'id': strings[id], 'title': strings[title]}
+                                   for id, title in result['items']]
+        data['queries'] = queries
+        return data
+
+    def get_item(self, basename, id):
+        with zipfile.ZipFile(self.path) as archive:
+            try:
+                return json.loads(archive.read(f'items/{basename}/{id}.json'))
+            except KeyError:
+                return None
+
+    def items(self):
+        '''All the `(basename, id, payload)` items, payloads being kept serialized'''
+        with zipfile.ZipFile(self.path) as archive:
+            for name in archive.namelist():
+                if name.startswith('items/'):
+                    _, basename, filename = name.split('/')
+                    yield basename, filename[:-len('.json')], archive.read(name)
+
+    def write(self, data, items):
+        '''Pack some run results with its `(basename, id, payload)` items'''
+        strings = {}
+
+        def ref(string):
+            return strings.setdefault(string, len(strings))
+
+        queries = []
+        for result in data['queries']:
+            if result and result.get('items'):
+                result = {**result, 'items': [[ref(item['id']), ref(item.get('title'))]
+                                              for item in result['items']]}
+            queries.append(result)
+        header = {key: value for key, value in data.items() if key != 'queries'}
+        with atomic_write(self.path, 'wb') as output:
+            with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('header.json', json.dumps(header, ensure_ascii=False))
+                archive.writestr('strings.json', json.dumps(list(strings), ensure_ascii=False))
+                archive.writestr('queries.json', json.dumps(queries, ensure_ascii=False))
+                for basename, id, payload in items:
+                    archive.writestr(f'items/{basename}/{id}.json', payload)
+        with atomic_write(self.path.with_name('pack.json'), encoding='utf-8') as jsonfile:
+            json.dump({'file': self.path.name, 'items': self.index()}, jsonfile)
+        precompress(self.path.with_name('queries.json'),
+                    json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def index(self):
+        '''
+        Each item compressed data `[offset, length]` in the archive
+        (raw deflate data, so it can be fetched with a HTTP range request)
+        '''
+        index = {}
+        with self.path.open('rb') as binfile, zipfile.ZipFile(binfile) as archive:
+            for info in archive.infolist():
+                if not info.filename.startswith('items/'):
+                    continue
+                # The local file header has its own file name and extra field lengths
+                binfile.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', binfile.read(4))
+                offset = info.header_offset + 30 + name_length + extra_length
+                _, basename, filename = info.filename.split('/')
+                index.setdefault(basename, {})[filename[:-len('.json')]] = [
+                    offset, info.compress_size
+                ]
+        return index
+
+
+def pack_run(root):
+    '''
+    Pack a run directory into a `RunPack`, removing its `queries.json`,
+    items manifest and items directories (items stay in the content-addressed store).
+    '''
+    root = Path(root)
+    data = load_run(root / 'queries.json')
+    manifest = {}
+    if (root / 'items.json').exists():
+        with (root / 'items.json').open(encoding='utf-8') as jsonfile:
+            manifest = json.load(jsonfile)
+
+    def items():
+        for basename, hashes in sorted(manifest.items()):
+            for id, hash in sorted(hashes.items()):
+                yield basename, id, (root.parent / 'objects' / f'{hash}.json').read_bytes()
+        for basename in ITEMS_DIRS:
+            for filename in sorted((root / basename).glob('*.json')):
+                yield basename, filename.stem, filename.read_bytes()
+
+    RunPack(root / PACK_FILE).write(data, items())
+    (root / 'queries.json').unlink()
+    if manifest:
+        (root / 'items.json').unlink()
+    for basename in ITEMS_DIRS:
+        if (root / basename).is_dir():
+            shutil.rmtree(root / basename)
+
+
+QUERY_INDEX_VERSION = 2  # Queries indexes written by another version are rewritten
+QUERY_SUMMARY_FIELDS = ('uid', 'model', 'query', 'params', 'expected', 'title', 'found', 'rank',
+                        'page', 'total')
+
+
+def write_query_index(root, data):
+    '''
+    Write a run queries split by model for the dashboard to only load what it displays.
+
+    `index.json` holds the run fields and each model queries `count` and files:
+    their `summaries` in `queries/<model>.json`, with the `offset` and `length` (in bytes)
+    of their details, written as JSON lines into `queries/<model>.jsonl`.
+    '''
+    root = Path(root)
+    runners = DatasetRunner, OrgRunner, ReuseRunner
+    basenames = {runner.model: runner.basename for runner in runners}
+    (root / 'queries').mkdir(exist_ok=True)
+    lines = {}
+    for result in data['queries']:
+        # Failed queries may have lost their details
+        if result and result.get('model') in basenames:
+            lines.setdefault(result['model'], []).append(result)
+    models = {}
+    for model, results in sorted(lines.items()):
+        file = f'queries/{basenames[model]}.jsonl'
+        summaries = []
+        offset = 0
+        with atomic_write(root / file, 'wb') as jsonfile:
+            for result in results:
+                line = json.dumps(result, ensure_ascii=False).encode('utf-8')
+                jsonfile.write(line + b'\n')
+                summaries.append({
+                    **{field: result.get(field) for field in QUERY_SUMMARY_FIELDS},
+                    'error': bool(result.get('error')),
+                    'offset': offset,
+                    'length': len(line),
+                })
+                offset += len(line) + 1
+        summaries_file = f'queries/{basenames[model]}.json'
+        with atomic_write(root / summaries_file, encoding='utf-8') as jsonfile:
+            json.dump(summaries, jsonfile, ensure_ascii=False)
+        precompress(root / summaries_file)
+        models[model] = {'count': len(results), 'summaries': summaries_file, 'file': file}
+    index = {key: value for key, value in data.items() if key != 'queries'}
+    index.update(index_version=QUERY_INDEX_VERSION, models=models)
+    with atomic_write(root / 'index.json', encoding='utf-8') as jsonfile:
+        json.dump(index, jsonfile, ensure_ascii=False)
+    precompress(root / 'index.json')
+
+
+def read_query_index(filename):
+    '''A run queries index if it is up to date with its results file (or `None`)'''
+    filename = Path(filename)
+    index = filename.with_name('index.json')
+    if not index.exists() or index.stat().st_mtime_ns < filename.stat().st_mtime_ns:
+        return None
+    with index.open(encoding='utf-8') as jsonfile:
+        data = json.load(jsonfile)
+    return data if data.get('index_version') == QUERY_INDEX_VERSION else None
+
+
+def load_summaries(filename):
+    '''
+    Load a run fields and its queries summaries (see `QUERY_SUMMARY_FIELDS`),
+    only reading its models summaries if its queries index is up to date.
+    '''
+    index = read_query_index(filename)
+    if index is None:
+        return load_run(filename)
+    queries = []
+    for model in index.pop('models').values():
+        with (Path(filename).parent / model['summaries']).open(encoding='utf-8') as jsonfile:
+            queries.extend(json.load(jsonfile))
+    index.pop('index_version')
+    return {**index, 'queries': queries}
+
+
+def update_query_indexes(base):
+    '''Write the queries index of the runs which changed since it has been written'''
+    written = 0
+    for filename in run_files(base):
+        if read_query_index(filename) is None:
+            write_query_index(filename.parent, load_run(filename))
+            written += 1
+    return written
+
+
+def dashboard_file(file):
+    '''The results file the dashboard loads for a run file (precompressed if packed)'''
+    if os.path.basename(file) == PACK_FILE:
+        return os.path.join(os.path.dirname(file), 'queries.json.gz')
+    return file
+
+
+class RunIndex:
+    '''
+    A persistent index of a domain runs summaries.
+
+    Each run entry is stored with its `queries.json` (or archive, if packed)
+    modification time and size so it is only read again when it has changed.
+    '''
+    def __init__(self, domain):
+        self.base_path = Path('data') / domain
+        self.path = self.base_path / 'runs.json'
+        self.runs = {}
+        self.stats = Counter()
+        if self.path.exists():
+            with self.path.open(encoding='utf-8') as jsonfile:
+                data = json.load(jsonfile)
+            # Any change in the summary fields invalidates the whole index
+            if data.get('fields') == list(TOC_FIELDS):
+                self.runs = data['runs']
+
+    def update(self):
+        '''Synchronize the index with the runs on disk'''
+        self.stats = Counter()
+        runs = {}
+        for filename in run_files(self.base_path):
+            file = filename.relative_to(self.base_path).as_posix()
+            stat = filename.stat()
+            entry = self.runs.get(file)
+            if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+                self.stats['unchanged'] += 1
+            else:
+                try:
+                    data = read_header(filename)
+                except ValueError:
+                    data = load_run(filename)
+                entry = {
+                    'mtime': stat.st_mtime_ns,
+                    'size': stat.st_size,
+                    'summary': {field: data.get(field) for field in TOC_FIELDS},
+                }
+                self.stats['parsed'] += 1
+            runs[file] = entry
+        self.stats['removed'] = len(set(self.runs) - set(runs))
+        self.runs = runs
+        return self
+
+    def save(self):
+        with atomic_write(self.path, encoding='utf-8') as jsonfile:
+            json.dump({'fields': TOC_FIELDS, 'runs': self.runs}, jsonfile, ensure_ascii=False)
+
+    def toc(self):
+        # Sampled and replayed runs are not comparable with the full runs history
+        toc = [
+            {'file': dashboard_file(file), 'dirname': os.path.dirname(file), **entry['summary']}
+            for file, entry in self.runs.items()
+            if is_full_run(entry['summary'])
+        ]
+        toc.sort(key=lambda r: r['date'])
+        return toc
+
+
+class RunMatrix:
+    '''
+    A compact columnar store of every query outcome across a domain runs.
+
+    Queries (identified by their key) and runs are the two axes of the matrix
+    whose `rank`, `total` and `flags` (present/found/error) columns are stored
+    as binary arrays, run after run: a run only stores the queries known when it was added
+    (queries appearing later are considered absent from it).
+    New runs are appended incrementally, the matrix is rebuilt if a known run changed.
+    '''
+    COLUMNS = {'rank': 'i', 'total': 'i', 'flags': 'B'}
+    PRESENT = 1
+    FOUND = 2
+    ERROR = 4
+
+    def __init__(self, domain):
+        self.base_path = Path('data') / domain
+        self.path = self.base_path / 'matrix'
+        self.reset()
+        meta = self.path / 'matrix.json'
+        if meta.exists():
+            with meta.open(encoding='utf-8') as jsonfile:
+                data = json.load(jsonfile)
+            self.queries = [tuple(key) for key in data['queries']]
+            self.runs = data['runs']
+            for name, typecode in self.COLUMNS.items():
+                with (self.path / f'{name}.bin').open('rb') as binfile:
+                    self.columns[name].frombytes(binfile.read())
+        self.keys = {key: index for index, key in enumerate(self.queries)}
+
+    def reset(self):
+        self.queries = []
+        self.keys = {}
+        self.runs = []
+        self.columns = {name: array.array(typecode) for name, typecode in self.COLUMNS.items()}
+
+    def update(self):
+        '''Append new runs, rebuilding the whole matrix if a known run changed'''
+        known = {run['file']: run for run in self.runs}
+        found = {}
+        for filename in run_files(self.base_path):
+            stat = filename.stat()
+            file = filename.relative_to(self.base_path).as_posix()
+            found[file] = (stat.st_mtime_ns, stat.st_size)
+        outdated = any(
+            found.get(file) != (run['mtime'], run['size']) or 'replay' not in run
+            for file, run in known.items()
+        )
+        if outdated:
+            self.reset()
+            known = {}
+        added = 0
+        for file in sorted(set(found) - set(known)):
+            self.append(file, found[file], load_run(self.base_path / file))
+            added += 1
+        self.runs.sort(key=lambda r: r['date'])
+        return added
+
+    def append(self, file, stat, data):
+        values = {}
+        for key, result in keyed_results(data['queries']):
+            if key not in self.keys:
+                self.keys[key] = len(self.queries)
+                self.queries.append(key)
+            values[self.keys[key]] = result
+        offset = len(self.columns['flags'])
+        count = len(self.queries)
+        for index in range(count):
+            result = values.get(index)
+            if result is None:
+                rank, total, flags = 0, 0, 0
+            else:
+                rank = result['rank'] if result['found'] else 0
+                total = result.get('total') or 0
+                flags = self.PRESENT
+                flags |= self.FOUND if result['found'] else 0
+                flags |= self.ERROR if result.get('error') else 0
+            self.columns['rank'].append(rank)
+            self.columns['total'].append(total)
+            self.columns['flags'].append(flags)
+        self.runs.append({
+            'file': file,
+            'dirname': os.path.dirname(file),
+            'date': data['date'],
+            'mtime': stat[0],
+            'size': stat[1],
+            'offset': offset,
+            'count': count,
+            'sample': bool(data.get('sample')),
+            'replay': data.get('replay'),
+        })
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        for name, column in self.columns.items():
+            with atomic_write(self.path / f'{name}.bin', 'wb') as binfile:
+                column.tofile(binfile)
+        with atomic_write(self.path / 'matrix.json', encoding='utf-8') as jsonfile:
+            json.dump({'queries': self.queries, 'runs': self.runs}, jsonfile, ensure_ascii=False)
+
+    def column(self, name, run):
+        return self.columns[name][run['offset']:run['offset'] + run['count']]
+
+    def outcomes(self, run):
+        '''The (rank, flags) of each query present in a run (rank being 0 if not found)'''
+        return [
+            (rank, flags)
+            for rank, flags in zip(self.column('rank', run), self.column('flags', run))
+            if flags & self.PRESENT
+        ]
+
+    def run_metrics(self, run, ks=(1, 3, 10)):
+        '''
+        Compute a run ranking metrics:
+        Mean Reciprocal Rank, recall at each k
+        and NDCG (with a single relevant item per query).
+        '''
+        outcomes = self.outcomes(run)
+        count = len(outcomes) or 1
+        found = [rank for rank, flags in outcomes if flags & self.FOUND]
+        return {
+            'dirname': run['dirname'],
+            'date': run['date'],
+            'sample': run['sample'],
+            'replay': run['replay'],
+            'queries': len(outcomes),
+            'mrr': sum(1 / rank for rank in found) / count,
+            'ndcg': sum(1 / math.log2(rank + 1) for rank in found) / count,
+            'recall': {str(k): sum(1 for rank in found if rank <= k) / count for k in ks},
+        }
+
+    def regressions(self, before, after):
+        '''Queries whose rank got worse between two runs (not found being the worst)'''
+        def position(rank, flags):
+            return rank if flags & self.FOUND else math.inf
+
+        columns = zip(self.column('rank', before), self.column('flags', before),
+                      self.column('rank', after), self.column('flags', after))
+        regressions = []
+        for index, (rank_a, flags_a, rank_b, flags_b) in enumerate(columns):
+            if not (flags_a & self.PRESENT and flags_b & self.PRESENT):
+                continue
+            if position(rank_b, flags_b) > position(rank_a, flags_a):
+                model, query, params, expected, _ = self.queries[index]
+                regressions.append({
+                    'model': model,
+                    'query': query,
+                    'params': json.loads(params),
+                    'expected': expected,
+                    'before': rank_a if flags_a & self.FOUND else None,
+                    'after': rank_b if flags_b & self.FOUND else None,
+                })
+        regressions.sort(key=lambda r: (r['after'] or math.inf) - (r['before'] or 0),
+                         reverse=True)
+        return regressions
+
+
+def diff_runs(before, after):
+    '''
+    Compare two runs results, joined by query key.
+
+    Returns the queries `gains` and `losses` (rank improved or worsened),
+    the `found` and `lost` ones (expected item newly found or no longer found),
+    the `added` and `removed` ones and the `ranks` histogram changes
+    as `(rank, before, after)` triplets.
+    '''
+    previous = dict(keyed_results(before['queries']))
+    diff = {name: [] for name in ('gains', 'losses', 'found', 'lost', 'added')}
+    for key, result in keyed_results(after['queries']):
+        old = previous.pop(key, None)
+        if old is None:
+            diff['added'].append(result)
+            continue
+        change = {'result': result, 'before': old['rank'], 'after': result['rank']}
+        if old['found'] and result['found']:
+            if result['rank'] < old['rank']:
+                diff['gains'].append(change)
+            elif result['rank'] > old['rank']:
+                diff['losses'].append(change)
+        elif result['found']:
+            diff['found'].append(change)
+        elif old['found']:
+            diff['lost'].append(change)
+    diff['removed'] = list(previous.values())
+    diff['gains'].sort(key=lambda c: c['before'] - c['after'], reverse=True)
+    diff['losses'].sort(key=lambda c: c['after'] - c['before'], reverse=True)
+    ranks_before, ranks_after = before.get('ranks', []), after.get('ranks', [])
+    diff['ranks'] = [
+        (rank, count_before, count_after)
+        for rank, (count_before, count_after) in enumerate(
+            itertools.zip_longest(ranks_before, ranks_after, fillvalue=0)
+        )
+        if count_before != count_after
+    ]
+    return diff
+
+
 @task
 def toc(ctx, domain=DEFAULT_DOMAIN):
-    '''Build the table of content for the dashboard'''
+    '''Build the table of content and the runs queries indexes for the dashboard'''
     header('Building TOC for {0}', domain)
-    base_path = os.path.join('data', domain)
-    toc = []
-    for filename in glob('data/{0}/*/queries.json'.format(domain)):
-        dirname = os.path.dirname(filename.replace(base_path + '/', ''))
-        with open(filename, encoding='utf-8') as jsonfile:
-            data = json.load(jsonfile)
-
-        toc.append({
-            'file': filename.replace(base_path + '/', ''),
-            'dirname': dirname,
-            'date': data['date'],
-            'total': data['total'],
-            'found': data['found'],
-            'ranks': data['ranks'],
-            'avg_rank': data['avg_rank'],
-            'score': data['score'],
-        })
-    toc.sort(key=lambda r: r['date'])
-    with open('data/{0}/toc.json'.format(domain), 'w', encoding='utf-8') as jsonfile:
-        json.dump(toc, jsonfile, sort_keys=True, indent=4, ensure_ascii=False)
+    index, indexed = write_toc(domain)
+    success('TOC built for {0} ({1[parsed]} runs parsed, {1[unchanged]} unchanged, '
+            '{2} queries indexes written)', domain, index.stats, indexed)
+
 
-    success('TOC built for {0}'.format(domain))
+def write_toc(domain, index=None):
+    '''
+    Update a domain runs `index` (loaded if not given), write its TOC
+    and the queries indexes of the runs which changed.
+
+    Returns the index and the number of queries indexes written.
+    '''
+    index = (index or RunIndex(domain)).update()
+    index.save()
+    with atomic_write('data/{0}/toc.json'.format(domain), encoding='utf-8') as jsonfile:
+        json.dump(index.toc(), jsonfile, sort_keys=True, indent=4, ensure_ascii=False)
+    precompress('data/{0}/toc.json'.format(domain))
+    return index, update_query_indexes(Path('data') / domain)
 
 
 @task
-def fix(ctx, domain=DEFAULT_DOMAIN):
-    '''Rebuild queries and tocs on model changes (if possible)'''
-    header('Fixing metadata')
-    for filename in glob('data/{0}/*/queries.json'.format(domain)):
-        info('Fixing {0}', filename)
-        # dirname = os.path.dirname(filename.replace(base_path + '/', ''))
-        with open(filename, encoding='utf-8') as jsonfile:
-            data = json.load(jsonfile)
+def pack(ctx, run=None, domain=DEFAULT_DOMAIN):
+    '''
+    Pack runs into single compressed archives
+
+    Packs the given run or all the complete runs not packed yet,
+    then removes the items no longer referenced from the content-addressed store
+    (unless a run is in progress).
+    '''
+    base = Path('data') / domain
+    if run:
+        roots = [base / Path(run).name]
+        if not (roots[0] / 'queries.json').exists():
+            raise Exit(f'No unpacked run {roots[0]}', code=2)
+    else:
+        roots = [path.parent for path in sorted(base.glob('*/queries.json'))]
+    header('Packing {0} runs for {1}', len(roots), domain)
+    for root in roots:
+        pack_run(root)
+        success('Packed {0}', root)
+    pruned = prune_objects(base)
+    if pruned is None:
+        info('A run is in progress, items store not pruned')
+    else:
+        info('{0} items pruned from the store', pruned)
+    toc(ctx, domain)
+
 
-        server = data['server']
-        timestamp = datetime.strptime(data['date'], '%Y-%m-%dT%H:%M:%S')
-        fixed = compile_results(server, timestamp, data['queries'])
+def prune_objects(base):
+    '''
+    Remove the items of the content-addressed store no run references anymore.
+
+    Returns the number of removed items, or `None` if a run is in progress
+    (its items are not referenced until it completes).
+    '''
+    objects = base / 'objects'
+    if any(base.glob('*/checkpoint.json')):
+        return None
+    if not objects.is_dir():
+        return 0
+    referenced = set()
+    for manifest in base.glob('*/items.json'):
+        with manifest.open(encoding='utf-8') as jsonfile:
+            for hashes in json.load(jsonfile).values():
+                referenced.update(hashes.values())
+    pruned = 0
+    for filename in objects.glob('*.json'):
+        if filename.stem not in referenced:
+            filename.unlink()
+            pruned += 1
+    return pruned
+
+
+def fix_file(filename, force=False):
+    '''
+    Recompile a run results if they have not been computed by the current metrics code.
+
+    Returns the filename, whether it has been fixed and the time spent.
+    '''
+    start = time.perf_counter()
+    version = metrics_version()
+    try:
+        current = read_header(filename).get('metrics') == version
+    except ValueError:
+        current = False
+    if current and not force:
+        return filename, False, time.perf_counter() - start
+
+    data = load_run(filename)
+
+    server = data['server']
+    timestamp = datetime.strptime(data['date'], '%Y-%m-%dT%H:%M:%S')
+    # Keep how the run has been made, which is not recomputed
+    fixed = {
+        **{field: data[field] for field in RUN_FIELDS if field in data},
+        **compile_results(server, timestamp, data['queries']),
+    }
 
-        with open(filename, 'w', encoding='utf-8') as jsonfile:
+    if Path(filename).name == PACK_FILE:
+        pack = RunPack(filename)
+        # Items are streamed from the previous archive, only replaced once the new one is written
+        pack.write(fixed, pack.items())
+    else:
+        with atomic_write(filename, encoding='utf-8') as jsonfile:
             json.dump(fixed, jsonfile, ensure_ascii=False)
-        success('Fixed  {0}', filename)
+    return filename, True, time.perf_counter() - start
+
+
+@task
+def fix(ctx, domain=DEFAULT_DOMAIN, jobs=None, force=False):
+    '''
+    Rebuild queries and tocs on model changes (if possible)
+
+    Runs are processed by a pool of `--jobs` processes (defaults to the CPU count)
+    and skipped if they have already been computed by the current metrics code,
+    unless `--force` is given.
+    '''
+    header('Fixing metadata')
+    filenames = [str(path) for path in run_files(Path('data') / domain)]
+    fixed = 0
+    with ProcessPoolExecutor(max_workers=int(jobs) if jobs else None) as executor:
+        futures = [executor.submit(fix_file, filename, force) for filename in filenames]
+        for future in as_completed(futures):
+            filename, changed, duration = future.result()
+            if changed:
+                fixed += 1
+                success('Fixed  {0} ({1:.3f}s)', filename, duration)
+            else:
+                info('Skipped {0}: up to date ({1:.3f}s)', filename, duration)
+    info('{0} runs fixed, {1} up to date', fixed, len(filenames) - fixed)
     toc(ctx, domain)
 
 
+@task
+def matrix(ctx, domain=DEFAULT_DOMAIN, k='1,3,10'):
+    '''
+    Build the cross-runs queries matrix and history metrics
+
+    Writes `data/<domain>/matrix/metrics.json` with each run MRR, NDCG and recall at `--k`
+    and the queries regressions between the last two full (neither sampled nor replayed) runs.
+    '''
+    header('Building metrics matrix for {0}', domain)
+    matrix = RunMatrix(domain)
+    added = matrix.update()
+    matrix.save()
+    ks = [int(value) for value in k.split(',')]
+    runs = [matrix.run_metrics(run, ks) for run in matrix.runs]
+    full = [run for run in matrix.runs if is_full_run(run)]
+    regressions = matrix.regressions(*full[-2:]) if len(full) > 1 else []
+    with atomic_write(matrix.path / 'metrics.json', encoding='utf-8') as jsonfile:
+        json.dump({'runs': runs, 'regressions': regressions}, jsonfile, ensure_ascii=False)
+    success('Matrix built for {0}: {1} queries x {2} runs ({3} added)',
+            domain, len(matrix.queries), len(matrix.runs), added)
+    if runs:
+        last = runs[-1]
+        info('Last run: MRR {0:.3f}, NDCG {1:.3f}, {2}', last['mrr'], last['ndcg'],
+             ', '.join('recall@{0} {1:.3f}'.format(*r) for r in last['recall'].items()))
+    for regression in regressions[:10]:
+        info('Regression: {model} "{query}" {params} {before} → {after}', **regression)
+    if len(regressions) > 10:
+        info('... and {0} more regressions', len(regressions) - 10)
+
+
+@task
+def diff(ctx, run, domain=DEFAULT_DOMAIN, against='previous',
+         max_losses=None, max_lost=None, max_score_increase=None):
+    '''
+    Compare a run to another one and fail past regression thresholds
+
+    `inv diff <run> --against <other-run>` (`latest` can be used as run name),
+    `--against` defaulting to the `previous` run (`latest` and `previous` being full runs,
+    neither sampled nor replayed).
+    Exits non-zero if there are more than `--max-losses` rank losses,
+    more than `--max-lost` expected items no longer found
+    or if the score (lower is better) increased by more than `--max-score-increase`.
+    '''
+    base = Path('data') / domain
+    # Sampled and replayed runs are only compared when explicitly given
+    runs = [path.parent.name for path in full_run_files(base)]
+    run_b = runs[-1] if run == 'latest' and runs else Path(run).name
+    if against == 'previous':
+        older = [name for name in runs if name < run_b]
+        if not older:
+            raise Exit(f'No run before {run_b}', code=2)
+        run_a = older[-1]
+    else:
+        run_a = Path(against).name
+    data = []
+    files = {path.parent.name: path for path in run_files(base)}
+    for name in run_a, run_b:
+        if name not in files:
+            raise Exit(f'Unknown run {base / name}', code=2)
+        data.append(load_summaries(files[name]))
+    before, after = data
+    header('Comparing {0} to {1} on {2}', run_b, run_a, domain)
+    changes = diff_runs(before, after)
+    for name in 'gains', 'losses', 'found', 'lost':
+        info('{0} {1}', len(changes[name]), name)
+        for change in changes[name][:10]:
+            result = change['result']
+            info('    {model} "{query}" {params}: {0} → {1}',
+                 change['before'] if change['before'] is not None else '-',
+                 change['after'] if change['after'] is not None else '-', **result)
+    info('{0} queries added, {1} removed', len(changes['added']), len(changes['removed']))
+    for rank, count_before, count_after in changes['ranks']:
+        info('Rank {0}: {1} → {2} ({3:+d})', rank, count_before, count_after,
+             count_after - count_before)
+    score_increase = (after.get('score') or 0) - (before.get('score') or 0)
+    info('Score: {0} → {1}', before.get('score'), after.get('score'))
+
+    failures = []
+    if max_losses is not None and len(changes['losses']) > int(max_losses):
+        failures.append('{0} rank losses (max {1})'.format(len(changes['losses']), max_losses))
+    if max_lost is not None and len(changes['lost']) > int(max_lost):
+        failures.append('{0} lost items (max {1})'.format(len(changes['lost']), max_lost))
+    if max_score_increase is not None and score_increase > float(max_score_increase):
+        failures.append('score increased by {0:.3f} (max {1})'.format(
+            score_increase, max_score_increase))
+    for failure in failures:
+        error('Regression: {0}', failure)
+    if failures:
+        raise Exit(code=1)
+    success('No regression past thresholds')
+
+
+@task
+def benchmark(ctx, queries='100,10000,100000', latency='lognormal:0.005:0.5', error_rate=0):
+    '''
+    Benchmark the runner throughput against a fake udata API
+
+    Each scenario runs `--queries` queries (comma-separated numbers),
+    the fake API responding with the given `--latency` distribution and `--error-rate`.
+    Results are appended to `benchmarks/results.jsonl` (see `benchmarks/bench.py --help`).
+    '''
+    header('Benchmarking the runner')
+    ctx.run(f'{sys.executable} benchmarks/bench.py --queries {queries} '
+            f'--latency {latency} --error-rate {error_rate}', pty=sys.stdout.isatty())
+
+
 @task
 def event(ctx, label, domain=DEFAULT_DOMAIN):
     '''Insert a notable event in the timeline'''
@@ -495,16 +2758,402 @@ def event(ctx, label, domain=DEFAULT_DOMAIN):
 
 @task
 def run(ctx, domain=DEFAULT_DOMAIN, max_pages=3, scheme='https', timeout=TIMEOUT,
-        concurrency=CONCURRENCY, verbose=False):
-    '''Run benchmarch on a given domain'''
-    header('Running benchmark on {0}', domain)
+        concurrency=CONCURRENCY, verbose=False, lean=False, fetch_items=True,
+        cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, speculative=False,
+        max_concurrency=MAX_CONCURRENCY, retries=RETRIES, workers=WORKERS, resume=None,
+        record=None, replay=None, replay_latency=0, profile=None, progress='auto',
+        shard=None, run_id=None, sample=None, strata='model', seed=0, pack=False):
+    '''
+    Run benchmarch on a given domain
+
+    Concurrency starts at `--concurrency` simultaneous requests
+    and adapts to the server response times up to `--max-concurrency`.
+    Failed requests are retried up to `--retries` times.
+    Each model queries are processed by a pool of `--workers`.
+    Use `--resume <run-dir>` to complete an interrupted run.
+
+    Use `--lean` to rank from search payloads only
+    and `--no-fetch-items` to skip fetching the ranked items payloads.
+    Use `--speculative` to request all search pages of a query at once.
+    Items are cached across runs for `--cache-ttl` seconds,
+    up to `--cache-size` MB.
+
+    Use `--record <cassette>` to record all API responses
+    and `--replay <cassette>` to run offline from them,
+    with their recorded latency multiplied by `--replay-latency`.
+
+    Use `--profile <file>` to dump the runner cProfile stats into `file`
+    and display its most time consuming functions and phases.
+
+    Use `--pack` to store the run as a single archive (see `inv pack`).
+
+    Progress is displayed according to `--progress`: `tty`, `json` (JSON lines),
+    `quiet` or `auto` (`tty` on a terminal, `json` otherwise).
+
+    Use `--shard i/N --run-id <id>` to only run the i-th of N shards of the queries
+    (an interrupted shard is resumed when run again), then `inv merge <id>`.
+
+    Use `--sample N` to only run a deterministic sample of N queries
+    stratified by `--strata` (comma-separated among `model` and `found-in-last-run`,
+    the outcome of the query in the latest full run), changing it with `--seed`.
+    Metrics confidence intervals give the sampled run error bars.
+    '''
+    check_progress(progress)
+    sample, strata = parse_sampling(sample, strata)
+    cassette = open_cassette(record, replay, replay_latency)
+    if shard:
+        shard = parse_shard(shard, run_id)
+        root = shard_root(Path('data') / domain, run_id, shard[0])
+        if (root / 'checkpoint.json').exists():
+            resume = root
+            header('Resuming shard {0}/{1} of {2} on {3}', *shard, run_id, domain)
+        elif (root / 'queries.json').exists():
+            raise Exit(f'Shard {root} is already complete', code=2)
+        else:
+            header('Running shard {0}/{1} of {2} on {3}', *shard, run_id, domain)
+    elif resume:
+        resume = Path('data') / domain / Path(resume).name
+        if not resume.is_dir():
+            error('Unknown run {0}', resume)
+            return
+        if not (resume / 'checkpoint.json').exists():
+            error('Run {0} has no checkpoint (it may be already complete)', resume)
+            return
+        header('Resuming benchmark {0} on {1}', resume.name, domain)
+    else:
+        header('Running benchmark on {0}', domain)
     loop = asyncio.get_event_loop()
     # Report all mistakes managing asynchronous resources.
     if verbose:
         loop.set_debug(True)
         warnings.simplefilter('always', ResourceWarning)
-    runner = Runner(domain, max_pages, scheme, timeout, concurrency)
-    results = loop.run_until_complete(runner.process())
+    runner = Runner(domain, max_pages, scheme, timeout, concurrency,
+                    lean=lean, fetch_items=fetch_items, cache_ttl=cache_ttl, cache_size=cache_size,
+                    speculative=speculative, max_concurrency=max_concurrency, retries=retries,
+                    workers=workers, resume=resume, cassette=cassette, progress=progress,
+                    shard=shard, run_id=run_id, sample=sample, strata=strata, seed=int(seed))
+    start = time.monotonic()
+    with profiling(profile):
+        loop.run_until_complete(runner.process())
+    duration = time.monotonic() - start
     loop.close()
-    success('Benchmark run {0} queries on {1}', len(results), domain)
+    if cassette:
+        cassette.close()
+    report(runner)
+    if profile:
+        report_profile(runner, profile, duration)
+    if shard:
+        success('Shard written to {0}', runner.root)
+    else:
+        if pack:
+            pack_run(runner.root)
+            info('Run packed into {0}', runner.root / PACK_FILE)
+        toc(ctx, domain)
+
+
+def parse_shard(shard, run_id):
+    '''Parse a `i/N` shard specification into a `(i, N)` tuple'''
+    if not run_id:
+        raise Exit('A --run-id shared by all shards is required', code=2)
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise Exit(f'Invalid shard {shard}, expected i/N', code=2)
+    if not 1 <= index <= count:
+        raise Exit(f'Invalid shard {shard}, expected 1 <= i <= N', code=2)
+    return index, count
+
+
+@contextmanager
+def profiling(filename=None):
+    '''Profile the enclosed code and dump its stats into `filename` if any'''
+    if not filename:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+
+
+def report_profile(runner, filename, duration):
+    '''Display where the runner spent its time'''
+    phases = Counter()
+    for histograms in runner.metrics.latencies.values():
+        for name, histogram in histograms.items():
+            phases[name] += histogram.total / 1000
+    info('Run took {0:.2f}s, queries cumulated {1[wait]:.2f}s waiting for the limiter, '
+         '{1[search]:.2f}s searching and {1[item]:.2f}s fetching expected items',
+         duration, phases)
+    info('Most time consuming functions (full stats in {0}):', filename)
+    stats = pstats.Stats(filename, stream=sys.stdout)
+    stats.sort_stats('tottime').print_stats(15)
+
+
+@task
+def run_all(ctx, config='data/config.json', max_pages=3, scheme='https', timeout=TIMEOUT,
+            concurrency=CONCURRENCY, global_concurrency=GLOBAL_CONCURRENCY, verbose=False,
+            lean=False, fetch_items=True, cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE,
+            speculative=False, max_concurrency=MAX_CONCURRENCY, retries=RETRIES,
+            workers=WORKERS, record=None, replay=None, replay_latency=0, progress='auto'):
+    '''
+    Run benchmark on all configured domains at once
+
+    Each domain concurrency adapts from `--concurrency` up to `--max-concurrency`
+    simultaneous requests and all domains share a `--global-concurrency` budget.
+    Other options are the same as the `run` task.
+    '''
+    check_progress(progress)
+    with open(config, encoding='utf-8') as jsonfile:
+        domains = json.load(jsonfile)['domains']
+    header('Running benchmark on {0}', ', '.join(domains))
+    loop = asyncio.get_event_loop()
+    if verbose:
+        loop.set_debug(True)
+        warnings.simplefilter('always', ResourceWarning)
+    scheduler = Scheduler(global_concurrency)
+    # A single cassette can hold all domains responses
+    cassette = open_cassette(record, replay, replay_latency)
+    runners = [
+        Runner(domain, max_pages, scheme, timeout, concurrency,
+               lean=lean, fetch_items=fetch_items, cache_ttl=cache_ttl, cache_size=cache_size,
+               speculative=speculative, scheduler=scheduler, max_concurrency=max_concurrency,
+               retries=retries, workers=workers, cassette=cassette)
+        for domain in domains
+    ]
+    bar = progress_bar('Querying {0} domains'.format(len(domains)), progress)
+    loop.run_until_complete(
+        bar.track(asyncio.gather(*(runner.process(bar) for runner in runners)))
+    )
+    loop.close()
+    if cassette:
+        cassette.close()
+    for runner in runners:
+        report(runner)
+        toc(ctx, runner.domain)
+
+
+@task
+def watch(ctx, domain=DEFAULT_DOMAIN, every='1h', jitter=WATCH_JITTER, status_port=STATUS_PORT,
+          runs=None, max_pages=3, scheme='https', timeout=TIMEOUT, concurrency=CONCURRENCY,
+          max_concurrency=MAX_CONCURRENCY, retries=RETRIES, workers=WORKERS, lean=False,
+          fetch_items=True, cache_ttl=CACHE_TTL, cache_size=CACHE_SIZE, speculative=False,
+          sample=None, strata='model', seed=0, pack=False, progress='auto'):
+    '''
+    Run the benchmark on a given domain every `--every` period (ie. `30m`, `1h`)
+
+    The process stays alive between runs, keeping its API connections and items cache warm.
+    Each run is delayed by up to `--jitter` times the period
+    and the TOC is updated after each of them.
+    The status and last run timings are served as JSON on `http://127.0.0.1:<status-port>/`
+    (`--status-port 0` to disable it).
+    Use `--runs N` to stop after N runs.
+    Other options are the same as `inv run` ones.
+    '''
+    check_progress(progress)
+    sample, strata = parse_sampling(sample, strata)
+    period = parse_duration(every)
+    if period < WATCH_MIN_PERIOD:
+        raise Exit(f'Runs can not be more frequent than every {WATCH_MIN_PERIOD}s', code=2)
+    watcher = Watcher(domain, period, float(jitter), int(status_port), pack=pack,
+                      max_pages=max_pages, scheme=scheme, timeout=timeout,
+                      concurrency=concurrency, max_concurrency=max_concurrency, retries=retries,
+                      cache_ttl=cache_ttl, cache_size=cache_size, workers=workers, lean=lean,
+                      fetch_items=fetch_items, speculative=speculative, sample=sample,
+                      strata=strata, seed=int(seed), progress=progress)
+    header('Watching {0} every {1}', domain, every)
+    if watcher.status_port:
+        info('Status served on http://127.0.0.1:{0}/', watcher.status_port)
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(watcher.watch(int(runs) if runs else None))
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # Let the watcher close its status server, connections and cache
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        info('Interrupted, an incomplete run can be completed with `inv run --resume <run-dir>`')
+    finally:
+        loop.close()
+    success('Watched {0}: {1[runs]} runs, {1[failures]} failures', domain, watcher.status)
+
+
+@task
+def merge(ctx, run_id, domain=DEFAULT_DOMAIN, keep_shards=False):
+    '''
+    Merge all the shards of a distributed run into a single run
+
+    Metrics are computed over all shards queries (run with the same sampling, if any),
+    shards items are moved into the shared store (if not already there)
+    and shards are removed unless `--keep-shards` is given.
+    '''
+    base = Path('data') / domain
+    shards_dir = base / 'shards' / run_id
+    shards = sorted(shards_dir.glob('*/'), key=lambda path: int(path.name))
+    if not shards:
+        raise Exit(f'No shard found for run {run_id}', code=2)
+    headers = []
+    for path in shards:
+        if (path / 'checkpoint.json').exists() or not (path / 'queries.json').exists():
+            raise Exit(f'Shard {path} is not complete', code=2)
+        headers.append(read_header(path / 'queries.json'))
+    counts = {int(data['shard'].split('/')[1]) for data in headers}
+    missing = set(range(1, max(counts) + 1)) - {int(path.name) for path in shards}
+    if len(counts) > 1 or missing:
+        raise Exit('Missing or inconsistent shards {0}'.format(
+            ', '.join(str(index) for index in sorted(missing)) or counts), code=2)
+    # Sampled shards select their queries among the same sample
+    if len({json.dumps(data.get('sample'), sort_keys=True) for data in headers}) > 1:
+        raise Exit('Shards were not run with the same sampling', code=2)
+
+    header('Merging {0} shards of {1} on {2}', len(shards), run_id, domain)
+    # The run is dated after its first shard
+    date = min(datetime.strptime(data['date'], '%Y-%m-%dT%H:%M:%S') for data in headers)
+    root = base / date.strftime(RUN_FORMAT)
+    if (root / 'queries.json').exists():
+        raise Exit(f'Run {root} already exists', code=2)
+    root.mkdir(parents=True, exist_ok=True)
+    objects = base / 'objects'
+    objects.mkdir(parents=True, exist_ok=True)
+
+    metrics = Metrics()
+    manifest = {}
+    stored = 0
+    results_file = root / 'queries.jsonl'
+    with results_file.open('w', encoding='utf-8') as output:
+        for path in shards:
+            with (path / 'queries.json').open(encoding='utf-8') as jsonfile:
+                results = json.load(jsonfile)['queries']
+            for result in results:
+                metrics.add(result)
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            with (path / 'items.json').open(encoding='utf-8') as jsonfile:
+                for basename, items in json.load(jsonfile).items():
+                    manifest.setdefault(basename, {}).update(items)
+            # Items are content-addressed: identical payloads are only stored once
+            for filename in (path / 'objects').glob('*.json'):
+                target = objects / filename.name
+                if not target.exists():
+                    if keep_shards:
+                        shutil.copyfile(str(filename), str(target))
+                    else:
+                        filename.replace(target)
+                    stored += 1
+
+    with (root / 'items.json').open('w', encoding='utf-8') as jsonfile:
+        json.dump(manifest, jsonfile, sort_keys=True)
+    summary = {**metrics.summary(headers[0]['server'], date), 'run_id': run_id}
+    if headers[0].get('sample'):
+        summary['sample'] = headers[0]['sample']
+    with results_file.open(encoding='utf-8') as lines:
+        with atomic_write(root / 'queries.json', encoding='utf-8') as jsonfile:
+            dump_results(jsonfile, summary, lines)
+    results_file.unlink()
+
+    if not keep_shards:
+        shutil.rmtree(str(shards_dir))
+        try:
+            shards_dir.parent.rmdir()
+        except OSError:  # Other runs shards
+            pass
+    success('Merged {0} queries into {1} ({2} new items stored)', metrics.total, root, stored)
     toc(ctx, domain)
+
+
+def parse_sampling(sample, strata):
+    '''Parse the `--sample` size and comma-separated `--strata` options'''
+    strata = [name.strip() for name in strata.split(',') if name.strip()]
+    unknown = set(strata) - set(Sampler.STRATA)
+    if unknown:
+        raise Exit('Unknown strata {0}, expected {1}'.format(
+            ', '.join(sorted(unknown)), ', '.join(Sampler.STRATA)), code=2)
+    if sample is not None:
+        sample = int(sample)
+        if sample < 1:
+            raise Exit('--sample expects a positive number of queries', code=2)
+    return sample, strata
+
+
+def parse_duration(duration):
+    '''Parse a duration like `90s`, `30m`, `1h` or `1d` (seconds by default) into seconds'''
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = str(duration).strip()
+    unit = units.get(value[-1:])
+    try:
+        return float(value[:-1] if unit else value) * (unit or 1)
+    except ValueError:
+        raise Exit(f'Invalid duration {duration}, expected ie. 90s, 30m, 1h or 1d', code=2)
+
+
+def check_progress(mode):
+    if mode != 'auto' and mode not in PROGRESS_MODES:
+        raise Exit('Unknown progress mode {0} (expected auto, {1})'.format(
+            mode, ', '.join(PROGRESS_MODES)), code=2)
+
+
+def open_cassette(record=None, replay=None, latency=0):
+    '''Open the cassette to record into or replay from, if any'''
+    if record and replay:
+        raise Exit('Either record or replay a cassette, not both', code=2)
+    if record:
+        return Cassette(record, 'record')
+    if replay:
+        try:
+            return Cassette(replay, 'replay', float(latency))
+        except FileNotFoundError as e:
+            raise Exit(str(e), code=2)
+    return None
+
+
+def report(runner):
+    '''Display a run summary'''
+    success('Benchmark run {0} queries on {1}', runner.metrics.total, runner.domain)
+    if runner.resume:
+        info('{0[resumed]} queries resumed from checkpoint', runner.stats)
+    if runner.sampler:
+        metrics = runner.metrics
+        confidence = metrics.confidence
+        info('Sampled {0[size]} of {0[population]} queries by {1} '
+             '(seed {0[seed]}, baseline {0[baseline]})',
+             runner.sampler.summary(runner.sample), ', '.join(runner.sampler.strata))
+        if confidence['found']:
+            info('{0:.0%} confidence: found {1:.1%} [{2[0]:.1%}, {2[1]:.1%}], '
+                 'score {3:.2f} [{4[0]:.2f}, {4[1]:.2f}]', confidence['level'],
+                 metrics.found / metrics.total, confidence['found'], metrics.score,
+                 confidence['score'])
+    info('{0} HTTP calls ({1[searches]} searches, {1[items_fetched]} items)',
+         runner.api.calls, runner.stats)
+    retries = ', '.join('{0}: {1}'.format(k, v) for k, v in runner.api.stats.items()
+                        if k != 'retries')
+    info('Concurrency settled on {0} ({1[increases]} increases, {1[backoffs]} backoffs), '
+         '{2} retries{3}', runner.limiter.concurrency, runner.limiter.stats,
+         runner.api.stats['retries'], f' ({retries})' if retries else '')
+    if runner.lean:
+        stats = runner.stats
+        info('Lean ranking: {0[hits]} hits ranked from search payloads, '
+             '{1} item requests while ranking, {0[items_batch_fetched]} after it '
+             '({0[items_batched]} items looked up), {0[items_skipped]} items not fetched',
+             stats, stats['items_fetched'] - stats['items_batch_fetched'])
+    info('{0[coalesced]} identical searches coalesced', runner.memo.stats)
+    if runner.speculative:
+        info('Speculative paging: {0[cancelled]} pages dropped, '
+             '{1[cancelled]} requests cancelled in flight', runner.stats, runner.memo.stats)
+    info('Connections: {0[new]} opened ({0[http2]} HTTP/2), {0[reused]} reused, '
+         '{1:.2f}s spent connecting', runner.api.pool.stats, runner.api.pool.connect_time)
+    info('Items cache: {0[hits]} hits, {0[revalidated]} revalidated, {0[misses]} misses, '
+         '{0[evicted]} evicted', runner.cache.stats)
+    for model, latencies in runner.metrics.latency.items():
+        info('{0} latency (p50/p95/p99): search {1[p50]}/{1[p95]}/{1[p99]}ms, '
+             'item {2[p50]}/{2[p95]}/{2[p99]}ms, wait {3[p50]}/{3[p95]}/{3[p99]}ms', model,
+             latencies['search'], latencies['item'], latencies['wait'])
+    cassette = runner.api.cassette
+    if cassette and cassette.recording:
+        info('Cassette: {0[recorded]} responses recorded in {1}', cassette.stats, cassette.path)
+    elif cassette:
+        info('Cassette: {0[replayed]} responses replayed, {0[misses]} misses', cassette.stats)